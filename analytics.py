@@ -0,0 +1,103 @@
+"""Business reporting from a read-only copy of the database.
+
+A job copies users.db to ANALYTICS_DB with the SQLite backup API, and every
+report query runs against that copy, so reporting never takes locks on the
+live database. Run from the command line:
+
+    python analytics.py --days 7
+    python analytics.py --snapshot   # refresh the copy first
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from telegram.ext import ContextTypes
+import storage
+
+# Analytics config
+ANALYTICS_DB = os.getenv('ANALYTICS_DB', 'analytics.db')
+ANALYTICS_SNAPSHOT_INTERVAL = int(os.getenv('ANALYTICS_SNAPSHOT_INTERVAL', '900'))  # Seconds between snapshots
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')  # Enables /admin/stats in webhook mode
+
+logger = logging.getLogger(__name__)
+
+def _backup():
+    tmp_path = f'{ANALYTICS_DB}.tmp'
+    source = sqlite3.connect(f'file:{storage.DB_PATH}?mode=ro', uri=True)
+    target = sqlite3.connect(tmp_path)
+    try:
+        # One step = one read transaction. Under WAL that doesn't block the
+        # writer, and a stepped backup would restart on every write it saw.
+        source.backup(target)
+        target.execute('PRAGMA journal_mode = DELETE')  # A plain file, readable without -wal/-shm
+    finally:
+        target.close()
+        source.close()
+    os.replace(tmp_path, ANALYTICS_DB)
+
+async def take_snapshot():
+    if storage.STORAGE_BACKEND != 'sqlite':
+        logger.warning("Analytics snapshots need the SQLite backend; point reports at a Postgres replica instead")
+        return
+    started = time.monotonic()
+    await asyncio.to_thread(_backup)
+    logger.info(f"Analytics snapshot written to {ANALYTICS_DB} in {time.monotonic() - started:.2f}s")
+
+async def snapshot_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await take_snapshot()
+    except Exception as e:
+        logger.error(f"Error taking analytics snapshot: {e}")
+
+def schedule(job_queue):
+    job_queue.run_repeating(snapshot_job, interval=ANALYTICS_SNAPSHOT_INTERVAL, first=300)
+
+def report(days=7):
+    """Aggregates over the last `days` days, read from the snapshot"""
+    if not os.path.exists(ANALYTICS_DB):
+        return {'error': f"No snapshot at {ANALYTICS_DB} yet"}
+    since = int(time.time()) - days * 86400
+    conn = sqlite3.connect(f'file:{ANALYTICS_DB}?mode=ro', uri=True)
+    try:
+        active = dict(conn.execute(
+            "SELECT current_session, count(*) FROM users WHERE current_session != 'none' GROUP BY current_session").fetchall())
+        revenue = {
+            level: {'payments': count, 'usdt': total / 10**6}
+            for level, count, total in conn.execute(
+                "SELECT level, count(*), sum(amount) FROM events WHERE kind = 'payment' AND created_utime >= ? GROUP BY level",
+                (since,))
+        }
+        sessions = {}
+        for kind, level, count in conn.execute(
+                "SELECT kind, level, count(*) FROM events WHERE kind IN ('session_start', 'session_end') AND created_utime >= ? "
+                "GROUP BY kind, level", (since,)):
+            sessions.setdefault(level, {})['started' if kind == 'session_start' else 'ended'] = count
+        # One 'message' event per exchange - the messages table itself gets compacted
+        messages = dict(conn.execute(
+            "SELECT date(created_utime, 'unixepoch'), count(*) FROM events WHERE kind = 'message' AND created_utime >= ? "
+            "GROUP BY 1 ORDER BY 1", (since,)).fetchall())
+        users = conn.execute('SELECT count(*) FROM users').fetchone()[0]
+    finally:
+        conn.close()
+    return {
+        'days': days,
+        'snapshot_age_seconds': int(time.time() - os.path.getmtime(ANALYTICS_DB)),
+        'users': users,
+        'active_sessions': active,
+        'revenue': revenue,
+        'revenue_total_usdt': sum(tier['usdt'] for tier in revenue.values()),
+        'sessions': sessions,
+        'messages_per_day': messages
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print business aggregates from the analytics snapshot')
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--snapshot', action='store_true', help='Take a fresh snapshot first')
+    args = parser.parse_args()
+    if args.snapshot:
+        asyncio.run(take_snapshot())
+    print(json.dumps(report(args.days), indent=2))
@@ -0,0 +1,243 @@
+"""Local stand-ins for the Telegram Bot API, OpenRouter, ModelsLab and TON Center.
+
+One FastAPI app serves all four so the bot can be benchmarked offline:
+
+    /bot<token>/<method>          Telegram Bot API
+    /openrouter/chat/completions  OpenRouter (plain and SSE streaming)
+    /modelslab/text2img           ModelsLab, answers "processing" then the image
+    /modelslab/render/<id>.png    the rendered image bytes
+    /toncenter/jetton/transfers   TON Center v3 jetton transfers
+
+Each upstream has its own latency and 429 rate. The /_control endpoints let
+the bench add TON transfers and read per-upstream request counters.
+
+    python bench/fakes.py --port 8765 --llm-latency 0.8 --llm-429 0.05
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import random
+import re
+import time
+from collections import Counter
+from urllib.parse import parse_qs
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+RENDER_BYTES = b'\x89PNG\r\n\x1a\n' + bytes(200 * 1024)  # Size of a typical 512x512 render
+def wallet(seed):
+    """(raw, user-friendly) address pair for a made-up wallet - TON Center reports the
+    raw form, wallets show users the friendly one"""
+    account = hashlib.sha256(str(seed).encode()).digest()
+    data = bytes([0x51, 0]) + account  # Non-bounceable, workchain 0
+    crc = 0
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            crc = (crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1
+    friendly = base64.urlsafe_b64encode(data + (crc & 0xFFFF).to_bytes(2, 'big')).decode()
+    return f'0:{account.hex().upper()}', friendly
+
+WORDS = "mmm babe you always know what to say to me and I love it when you talk like that tell me more".split()
+
+def text_of(content):
+    # Plain string, or OpenAI-style content parts
+    return content if isinstance(content, str) else ''.join(part.get('text', '') for part in content)
+
+def create_app(args):
+    app = FastAPI(docs_url=None, redoc_url=None, openapi_url=None)
+    stats = Counter()
+    transfers = []
+    address_book = {}  # raw address -> user-friendly form
+    renders = {}
+    message_ids = Counter()
+    cached_prefixes = set()
+
+    async def delay(latency):
+        if latency:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * latency)
+
+    def throttled(service, rate):
+        stats[f'{service}_requests'] += 1
+        if rate and random.random() < rate:
+            stats[f'{service}_429'] += 1
+            return True
+        return False
+
+    # Telegram
+    @app.post('/bot{token}/{method}')
+    async def telegram(method: str, request: Request):
+        body = await request.body()
+        if request.headers.get('content-type', '').startswith('multipart/'):
+            # Photo uploads - only chat_id matters here
+            match = re.search(rb'name="chat_id"\r\n\r\n(-?\d+)', body)
+            params = {'chat_id': match.group(1).decode() if match else '0', 'upload': str(len(body))}
+            stats['telegram_upload_bytes'] += len(body)
+        else:
+            params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+        await delay(args.tg_latency)
+        if method != 'getMe' and throttled('telegram', args.tg_429):
+            return JSONResponse({
+                'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                'parameters': {'retry_after': 1}
+            }, status_code=429)
+        stats[f'telegram_{method}'] += 1
+
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif method in ('sendMessage', 'sendPhoto', 'editMessageText'):
+            chat_id = int(params.get('chat_id', 0))
+            if method == 'editMessageText':
+                message_id = int(params['message_id'])
+            else:
+                message_ids[chat_id] += 1
+                message_id = message_ids[chat_id]
+            result = {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': params.get('text', '')
+            }
+            if method == 'sendPhoto':
+                # A file_id is reused as-is, anything else gets a new one
+                photo = params.get('photo', '')
+                file_id = photo if photo.startswith('bench-file-') else f'bench-file-{chat_id}-{message_id}'
+                stats['telegram_photo_by_file_id' if photo.startswith('bench-file-') else
+                      'telegram_photo_by_url' if photo else 'telegram_photo_by_upload'] += 1
+                result['photo'] = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 512, 'height': 512}]
+        else:
+            result = True
+        return {'ok': True, 'result': result}
+
+    # OpenRouter
+    @app.post('/openrouter/chat/completions')
+    async def completions(request: Request):
+        payload = await request.json()
+        await delay(args.llm_latency)
+        if throttled('llm', args.llm_429):
+            return JSONResponse({'error': {'message': 'Rate limit exceeded', 'code': 429}}, status_code=429)
+
+        # Sentences of 4-12 words; a reply longer than max_tokens is cut mid-sentence
+        words = []
+        while len(words) < args.llm_tokens:
+            sentence = [random.choice(WORDS) for _ in range(random.randint(4, 12))]
+            sentence[-1] += random.choice('.!?')
+            words.extend(sentence)
+        words = words[:args.llm_tokens]
+        finish_reason = 'length' if payload.get('max_tokens', args.llm_tokens) < len(words) else 'stop'
+        words = words[:payload.get('max_tokens', args.llm_tokens)]
+        if finish_reason == 'stop':
+            words[-1] = words[-1].rstrip('.!?') + ' 😘'
+        texts = [text_of(m['content']) for m in payload['messages']]
+        usage = {'prompt_tokens': sum(len(text) for text in texts) // 4, 'completion_tokens': len(words)}
+        # Prefix cache: a system prompt seen before counts as cached
+        if texts[0] in cached_prefixes:
+            usage['prompt_tokens_details'] = {'cached_tokens': len(texts[0]) // 4}
+        cached_prefixes.add(texts[0])
+        if not payload.get('stream'):
+            return {'choices': [{'message': {'role': 'assistant', 'content': ' '.join(words)}, 'finish_reason': finish_reason}],
+                    'usage': usage}
+
+        async def events():
+            for i, word in enumerate(words):
+                chunk = {'choices': [{'delta': {'content': word if i == 0 else ' ' + word}}]}
+                yield f'data: {json.dumps(chunk)}\n\n'
+                if args.llm_token_interval:
+                    await asyncio.sleep(args.llm_token_interval)
+            yield f'data: {json.dumps({"choices": [{"delta": {}, "finish_reason": finish_reason}]})}\n\n'
+            yield f'data: {json.dumps({"choices": [], "usage": usage})}\n\n'
+            yield 'data: [DONE]\n\n'
+
+        return StreamingResponse(events(), media_type='text/event-stream')
+
+    # ModelsLab
+    @app.post('/modelslab/text2img')
+    async def text2img(request: Request):
+        await delay(args.image_latency / 4)
+        if throttled('image', args.image_429):
+            return JSONResponse({'status': 'error', 'message': 'Rate limit exceeded'}, status_code=429)
+        render_id = str(len(renders) + 1)
+        renders[render_id] = time.monotonic() + random.uniform(0.5, 1.5) * args.image_latency
+        fetch_url = str(request.url_for('fetch_render', render_id=render_id))
+        return {'status': 'processing', 'eta': args.image_latency, 'fetch_result': fetch_url}
+
+    @app.post('/modelslab/fetch/{render_id}')
+    async def fetch_render(render_id: str, request: Request):
+        stats['image_fetches'] += 1
+        if time.monotonic() < renders[render_id]:
+            return {'status': 'processing', 'eta': renders[render_id] - time.monotonic(), 'fetch_result': str(request.url)}
+        return {'status': 'success', 'output': [str(request.url_for('render_bytes', render_id=render_id))]}
+
+    @app.get('/modelslab/render/{render_id}.png')
+    async def render_bytes(render_id: str):
+        await delay(args.image_host_latency)
+        stats['image_downloads'] += 1
+        return Response(RENDER_BYTES, media_type='image/png')
+
+    # TON Center
+    @app.get('/toncenter/jetton/transfers')
+    async def jetton_transfers(request: Request):
+        params = request.query_params
+        await delay(args.ton_latency)
+        if throttled('ton', args.ton_429):
+            return JSONResponse({'error': 'Ratelimit exceed'}, status_code=429)
+        start_lt = int(params.get('start_lt', 0))
+        start_utime = int(params.get('start_utime', 0))
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', 100))
+        matching = [t for t in transfers if int(t['transaction_lt']) >= start_lt and t['transaction_now'] >= start_utime]
+        page = matching[offset:offset + limit]
+        return {
+            'jetton_transfers': page,
+            'address_book': {t['source']: {'user_friendly': address_book[t['source']]} for t in page}
+        }
+
+    # Control
+    @app.post('/_control/transfer')
+    async def add_transfer(request: Request):
+        body = await request.json()
+        raw, friendly = wallet(body['wallet'])
+        address_book[raw] = friendly
+        lt = len(transfers) + 1
+        transfers.append({
+            'transaction_hash': f'bench{lt}',
+            'transaction_lt': str(lt),
+            'transaction_now': int(time.time()),
+            'source': raw,
+            'amount': str(body['amount'])
+        })
+        return {'ok': True}
+
+    @app.get('/_control/stats')
+    async def read_stats():
+        return dict(stats)
+
+    @app.get('/_control/health')
+    async def health():
+        return {'ok': True}
+
+    return app
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--tg-latency', type=float, default=0.03, help='Mean Bot API latency, seconds')
+    parser.add_argument('--tg-429', type=float, default=0.0, help='Fraction of Bot API calls answered with 429')
+    parser.add_argument('--llm-latency', type=float, default=0.8, help='Mean LLM time to first byte, seconds')
+    parser.add_argument('--llm-429', type=float, default=0.0)
+    parser.add_argument('--llm-tokens', type=int, default=40, help='Words per completion')
+    parser.add_argument('--llm-token-interval', type=float, default=0.02, help='Delay between streamed words, seconds')
+    parser.add_argument('--image-latency', type=float, default=4.0, help='Mean render time, seconds')
+    parser.add_argument('--image-429', type=float, default=0.0)
+    parser.add_argument('--image-host-latency', type=float, default=0.5, help='Mean time to serve a rendered image, seconds')
+    parser.add_argument('--ton-latency', type=float, default=0.2)
+    parser.add_argument('--ton-429', type=float, default=0.0)
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_args()
+    uvicorn.run(create_app(args), host=args.host, port=args.port, log_level='warning')
@@ -0,0 +1,333 @@
+"""Offline load test - drives the real bot handlers with simulated users.
+
+Starts bench/fakes.py in a subprocess, points the bot at it through the
+*_URL settings and a throwaway database, then replays each user's journey
+through Application.process_update():
+
+    /start -> /find_gf (5 answers) -> free chat -> /start_session + transfer
+    + /confirm -> paid chat -> /pic
+
+Reports p50/p95/p99 per step, chat messages/sec, DB lock waits and writer
+load, LLM outcomes and upstream 429s. Any option it doesn't know is passed to
+the fakes, e.g.
+
+    python bench/run.py --users 500 --ramp 20 --llm-latency 1.5 --llm-429 0.1
+    python bench/run.py --users 2000 --think 0 --json > before.json
+
+The database is a throwaway SQLite file unless STORAGE_BACKEND=postgres is
+set, in which case DATABASE_URL is used - point it at a scratch database,
+as the bench drops the bot's tables before it starts:
+
+    STORAGE_BACKEND=postgres DATABASE_URL=postgresql://localhost/bench python bench/run.py
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import httpx
+import fakes
+
+STEPS = ('start', 'find_gf', 'chat', 'start_session', 'confirm', 'pic')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--ramp', type=float, default=10, help='Seconds over which users arrive')
+    parser.add_argument('--think', type=float, default=1.0, help='Mean pause between a user\'s messages, seconds')
+    parser.add_argument('--messages', type=int, default=5, help='Free-preview chat messages per user')
+    parser.add_argument('--pay-rate', type=float, default=0.5, help='Fraction of users who buy a session')
+    parser.add_argument('--paid-messages', type=int, default=5)
+    parser.add_argument('--pics', type=int, default=1, help='/pic requests per paying user (buys moderate when > 0)')
+    parser.add_argument('--llm-rpm', type=float, default=6000, help='LLM_RATE_PER_MINUTE for the run')
+    parser.add_argument('--llm-concurrency', type=int, default=64, help='LLM_MAX_CONCURRENCY for the run')
+    parser.add_argument('--pacing', action='store_true', help='Keep humanized reply pacing (off by default)')
+    parser.add_argument('--no-stream', action='store_true', help='Send whole replies instead of streaming edits')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args, fake_argv = parser.parse_known_args()
+    args.fakes = fakes.parse_args(fake_argv)
+    return args, fake_argv
+
+def configure_env(args, db_dir):
+    base = f'http://127.0.0.1:{args.fakes.port}'
+    os.environ.update({
+        'DB_PATH': os.path.join(db_dir, 'bench.db'),
+        'TELEGRAM_TOKEN': '123456:bench',
+        'TELEGRAM_API_URL': base,
+        'OPENROUTER_API_KEY': 'bench',
+        'OPENROUTER_URL': f'{base}/openrouter/chat/completions',
+        'MODELSLAB_API_KEY': 'bench',
+        'MODELSLAB_URL': f'{base}/modelslab/text2img',
+        'TON_CENTER_URL': f'{base}/toncenter/jetton/transfers',
+        'MY_WALLET_ADDRESS': 'EQbench-wallet',
+        'PAYMENT_POLL_INTERVAL': '2',
+        'IMAGE_POLL_INTERVAL': '0.5',
+        'LLM_RATE_PER_MINUTE': str(args.llm_rpm),
+        'LLM_BURST': str(args.llm_concurrency),
+        'LLM_MAX_CONCURRENCY': str(args.llm_concurrency),
+        'STREAM_REPLIES': '0' if args.no_stream else '1',
+        'NO_PROXY': '127.0.0.1,localhost',
+    })
+    if not args.pacing:
+        os.environ.update({'PACING_MIN': '0', 'PACING_MAX': '0'})
+
+def start_fakes(args, fake_argv):
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, 'bench', 'fakes.py'), *fake_argv])
+    url = f'http://127.0.0.1:{args.fakes.port}/_control/health'
+    for _ in range(100):
+        try:
+            if httpx.get(url).status_code == 200:
+                return proc
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    proc.terminate()
+    raise SystemExit('fake upstreams did not start')
+
+class Simulation:
+    def __init__(self, args, app):
+        self.args = args
+        self.app = app
+        self.latencies = defaultdict(list)
+        self.updates = 0
+        self.errors = 0
+        self.control = httpx.AsyncClient(base_url=f'http://127.0.0.1:{args.fakes.port}')
+        import payments
+        self.amounts = payments.EXPECTED_NANO
+        self._update_id = 0
+
+    def _update(self, user_id, text):
+        self._update_id += 1
+        message = {
+            'message_id': self._update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'},
+            'text': text
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'update_id': self._update_id, 'message': message}
+
+    async def send(self, step, user_id, text):
+        from telegram import Update
+        update = Update.de_json(self._update(user_id, text), self.app.bot)
+        started = time.monotonic()
+        await self.app.process_update(update)
+        self.latencies[step].append(time.monotonic() - started)
+        self.updates += 1
+
+    async def think(self):
+        if self.args.think:
+            await asyncio.sleep(random.expovariate(1 / self.args.think))
+
+    async def user(self, user_id, delay):
+        args = self.args
+        await asyncio.sleep(delay)
+        await self.send('start', user_id, '/start')
+        await self.send('find_gf', user_id, '/find_gf')
+        for answer in ('Confident & sexy', 'brunette', 'curvy', 'Flirty & playful', '21'):
+            await self.think()
+            await self.send('find_gf', user_id, answer)
+
+        for i in range(args.messages):
+            await self.think()
+            await self.send('chat', user_id, f"hey babe, my name is User{user_id}, message {i} - how's your day?")
+
+        if random.random() >= args.pay_rate:
+            return
+        level = 'moderate' if args.pics else 'mild'
+        # Users paste the friendly address their wallet shows; TON Center reports the raw one
+        _, address = fakes.wallet(user_id)
+        await self.send('start_session', user_id, f'/start_session {level}')
+        await self.control.post('/_control/transfer', json={'wallet': user_id, 'amount': self.amounts[level]})
+        await self.think()
+        await self.send('confirm', user_id, f'/confirm {address}')
+
+        for i in range(args.paid_messages):
+            await self.think()
+            await self.send('chat', user_id, f'tell me something nice, part {i}')
+        for _ in range(args.pics):
+            await self.think()
+            # A real bot_command entity, handled by the /pic CommandHandler
+            await self.send('pic', user_id, '/pic at the beach at sunset')
+
+    async def run(self):
+        async def on_error(update, context):
+            self.errors += 1
+
+        self.app.add_error_handler(on_error)
+        spacing = self.args.ramp / max(self.args.users, 1)
+        started = time.monotonic()
+        await asyncio.gather(*(self.user(1000 + i, i * spacing) for i in range(self.args.users)))
+        # Let queued image renders finish before measuring
+        import images
+        while images.image_jobs.queue_depth() or images.image_jobs._per_user:
+            await asyncio.sleep(0.2)
+        self.wall = time.monotonic() - started
+        self.upstream = (await self.control.get('/_control/stats')).json()
+        await self.control.aclose()
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def histogram(name, **match):
+    """(count, sum, [(upper bound, cumulative count)]) summed over series matching the labels"""
+    from prometheus_client import REGISTRY
+    count, total, buckets = 0, 0.0, defaultdict(float)
+    for family in REGISTRY.collect():
+        if family.name != name:
+            continue
+        for sample in family.samples:
+            if any(sample.labels.get(key) != value for key, value in match.items()):
+                continue
+            if sample.name.endswith('_count'):
+                count += sample.value
+            elif sample.name.endswith('_sum'):
+                total += sample.value
+            elif sample.name.endswith('_bucket'):
+                buckets[float(sample.labels['le'])] += sample.value
+    return count, total, sorted(buckets.items())
+
+def histogram_quantile(buckets, count, q):
+    # Upper bound of the bucket the quantile falls in, like Prometheus without interpolation
+    for bound, cumulative in buckets:
+        if count and cumulative >= q * count:
+            return bound
+    return 0.0
+
+def counter(name, **match):
+    from prometheus_client import REGISTRY
+    totals = defaultdict(float)
+    for family in REGISTRY.collect():
+        if family.name != name:
+            continue
+        for sample in family.samples:
+            if sample.name.endswith('_total') and all(sample.labels.get(k) == v for k, v in match.items()):
+                totals[tuple(sorted(sample.labels.items()))] += sample.value
+    return totals
+
+def build_report(args, sim):
+    steps = {}
+    for step in STEPS:
+        values = sim.latencies.get(step, [])
+        if values:
+            steps[step] = {
+                'count': len(values),
+                'p50': percentile(values, 0.50),
+                'p95': percentile(values, 0.95),
+                'p99': percentile(values, 0.99),
+                'max': max(values)
+            }
+
+    db = {}
+    for kind in ('read', 'write'):
+        count, total, buckets = histogram('db_lock_wait_seconds', kind=kind)
+        call_count, call_total, _ = histogram('db_call_seconds', kind=kind)
+        db[kind] = {
+            'calls': int(call_count),
+            'wait_mean': total / count if count else 0.0,
+            'wait_p95': histogram_quantile(buckets, count, 0.95),
+            'wait_p99': histogram_quantile(buckets, count, 0.99),
+            # Time the thread(s) spent running statements, as a share of the run
+            'busy_share': max(call_total - total, 0.0) / sim.wall
+        }
+
+    llm = {}
+    for outcome in ('success', 'rate_limit', 'timeout', 'api_error', 'unavailable', 'unknown', 'max_retries'):
+        count, _, _ = histogram('llm_request_seconds', outcome=outcome)
+        if count:
+            llm[outcome] = int(count)
+    tokens = {dict(labels)['direction']: int(value) for labels, value in counter('llm_tokens').items()}
+    llm_requests = sum(llm.values())
+    image_count, image_total, image_buckets = histogram('image_generation_seconds')
+
+    return {
+        'users': args.users,
+        'wall_seconds': sim.wall,
+        'updates': sim.updates,
+        'handler_errors': sim.errors,
+        'error_rate': sim.errors / sim.updates if sim.updates else 0.0,
+        'chat_messages_per_second': len(sim.latencies.get('chat', [])) / sim.wall,
+        'updates_per_second': sim.updates / sim.wall,
+        'steps': steps,
+        'llm': {
+            'outcomes': llm,
+            'failure_rate': 1 - llm.get('success', 0) / llm_requests if llm_requests else 0.0,
+            'tokens': tokens,
+            'retries': int(sum(counter('llm_retries').values())),
+            'hedges': int(sum(counter('llm_hedges').values()))
+        },
+        'images': {'rendered': int(image_count), 'p95': histogram_quantile(image_buckets, image_count, 0.95)},
+        'db': db,
+        'upstream': sim.upstream
+    }
+
+def print_report(report):
+    print(f"\n{report['users']} users, {report['updates']} updates in {report['wall_seconds']:.1f}s "
+          f"({report['updates_per_second']:.1f} updates/s, {report['chat_messages_per_second']:.1f} chat msgs/s)")
+    print(f"handler errors: {report['handler_errors']} ({report['error_rate']:.2%})\n")
+    print(f"{'step':<15}{'count':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for step, s in report['steps'].items():
+        print(f"{step:<15}{s['count']:>8}{s['p50']:>9.3f}{s['p95']:>9.3f}{s['p99']:>9.3f}{s['max']:>9.3f}")
+
+    llm = report['llm']
+    print(f"\nLLM: {llm['outcomes']} failure rate {llm['failure_rate']:.2%}, "
+          f"retries {llm['retries']}, hedges {llm['hedges']}, tokens {llm['tokens']}")
+    print(f"images: {report['images']['rendered']} rendered, p95 <= {report['images']['p95']}s")
+    for kind, d in report['db'].items():
+        print(f"DB {kind}: {d['calls']} calls, lock wait mean {d['wait_mean'] * 1000:.2f}ms "
+              f"p95 <= {d['wait_p95'] * 1000:.1f}ms p99 <= {d['wait_p99'] * 1000:.1f}ms, busy {d['busy_share']:.1%}")
+    print(f"upstream: {report['upstream']}")
+
+def reset_database(storage):
+    # Every run starts from an empty schema, like the SQLite temp file
+    conn = storage.get_connection()
+    conn.execute(f"DROP TABLE IF EXISTS {', '.join(storage.TABLES)}")
+
+async def main(args):
+    import logging
+    import bot
+    import storage
+    logging.getLogger().setLevel(logging.WARNING)
+
+    if storage.backend.name == 'postgres':
+        reset_database(storage)
+    storage.init_db()
+    app = bot.build_application(run_jobs=True)
+    sim = Simulation(args, app)
+    async with app:
+        await app.post_init(app)
+        await app.start()
+        try:
+            await sim.run()
+        finally:
+            await app.stop()
+    await app.post_shutdown(app)
+    return build_report(args, sim)
+
+if __name__ == '__main__':
+    args, fake_argv = parse_args()
+    with tempfile.TemporaryDirectory() as db_dir:
+        configure_env(args, db_dir)
+        proc = start_fakes(args, fake_argv)
+        try:
+            report = asyncio.run(main(args))
+        finally:
+            proc.terminate()
+            proc.wait()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
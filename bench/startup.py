@@ -0,0 +1,120 @@
+"""Cold-start benchmark - how long each BOT_MODE takes to get to a ready app.
+
+Every sample runs in a fresh interpreter, so import costs are real:
+
+    import      importing the mode's entry module
+    init_db     storage.init_db() against a seeded database
+    build       building the Application (or the FastAPI app for webhook modes)
+
+init_db is measured three ways: on a brand-new file, on a database already at
+SCHEMA_VERSION (the normal restart), and with user_version reset to 0, which
+is what every boot cost before the version check.
+
+    python bench/startup.py --runs 7 --users 5000
+"""
+import argparse
+import json
+import os
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODES = {
+    'polling': ('import bot', 'bot.build_application()'),
+    'worker': ('import worker, bot', 'bot.build_application(run_jobs=False)'),
+    'webhook': ('import webhook', 'webhook.create_app()'),
+    'router': ('import webhook', 'webhook.create_app()'),
+}
+
+PROBE = '''
+import json, time
+t0 = time.perf_counter()
+{imports}
+t1 = time.perf_counter()
+import storage
+storage.init_db()
+t2 = time.perf_counter()
+{build}
+t3 = time.perf_counter()
+print(json.dumps({{'import': t1 - t0, 'init_db': t2 - t1, 'build': t3 - t2}}))
+'''
+
+INIT_PROBE = '''
+import json, time
+import storage
+t0 = time.perf_counter()
+storage.init_db()
+print(json.dumps({'init_db': time.perf_counter() - t0}))
+'''
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='Fresh interpreters per measurement')
+    parser.add_argument('--users', type=int, default=2000, help='Users seeded into the database')
+    parser.add_argument('--messages', type=int, default=20, help='Messages seeded per user')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    return parser.parse_args()
+
+def probe(code, env):
+    out = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env, capture_output=True, text=True)
+    if out.returncode != 0:
+        raise SystemExit(out.stderr)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+def sample(code, env, runs):
+    results = [probe(code, env) for _ in range(runs)]
+    return {phase: statistics.median(r[phase] for r in results) for phase in results[0]}
+
+def seed(db_path, users, messages):
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.executemany('INSERT INTO users (user_id, system_prompt, current_session) VALUES (?, ?, ?)',
+                         ((user_id, 'bench girlfriend', 'mild') for user_id in range(users)))
+        conn.executemany('INSERT INTO messages (user_id, seq, role, content) VALUES (?, ?, ?, ?)',
+                         ((user_id, seq, 'user' if seq % 2 else 'assistant', 'hey babe how was your day?')
+                          for user_id in range(users) for seq in range(1, messages + 1)))
+    conn.close()
+
+def set_user_version(db_path, version):
+    conn = sqlite3.connect(db_path)
+    conn.execute(f'PRAGMA user_version = {version}')
+    conn.close()
+
+def main():
+    args = parse_args()
+    report = {'init_db': {}, 'modes': {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'startup.db')
+        env = dict(os.environ, DB_PATH=db_path, JOB_LOCK_PATH=os.path.join(tmp, 'jobs.lock'),
+                   TELEGRAM_TOKEN='123456:bench', OPENROUTER_API_KEY='bench', METRICS_PORT='0')
+
+        report['init_db']['new'] = probe(INIT_PROBE, env)['init_db']
+        seed(db_path, args.users, args.messages)
+        report['init_db']['current'] = sample(INIT_PROBE, env, args.runs)['init_db']
+        legacy = []
+        for _ in range(args.runs):
+            set_user_version(db_path, 0)
+            legacy.append(probe(INIT_PROBE, env)['init_db'])
+        report['init_db']['unversioned'] = statistics.median(legacy)
+
+        for mode, (imports, build) in MODES.items():
+            mode_env = dict(env, BOT_MODE=mode, UPDATE_SHARDS='4' if mode == 'router' else '0')
+            report['modes'][mode] = sample(PROBE.format(imports=imports, build=build), mode_env, args.runs)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{args.users} users x {args.messages} messages, median of {args.runs} runs\n")
+    print('init_db: ' + ', '.join(f"{kind} {seconds * 1000:.1f}ms" for kind, seconds in report['init_db'].items()))
+    print(f"\n{'mode':<10}{'import':>10}{'init_db':>10}{'build':>10}{'total':>10}")
+    for mode, phases in report['modes'].items():
+        total = sum(phases.values())
+        print(f"{mode:<10}" + ''.join(f"{phases[phase] * 1000:>8.0f}ms" for phase in ('import', 'init_db', 'build'))
+              + f"{total * 1000:>8.0f}ms")
+
+if __name__ == '__main__':
+    main()
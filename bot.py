@@ -1,241 +1,147 @@
 import logging
-import sqlite3
-import requests
-import json
 import os
+import time
 import random
 import asyncio
-import uvicorn
-from fastapi import FastAPI
-from datetime import datetime, timedelta
 from telegram import Update
+from telegram.error import TelegramError
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler
-from telegram.constants import ChatAction
+from llm import OPENROUTER_API_KEY, make_openrouter_request, stream_openrouter_request, close_client
+from streaming import ProgressiveReply
+from scheduler import chat_scheduler, Overloaded, UserUpdateProcessor, hand_off
+from pacing import keep_typing, pace
+from images import image_jobs
+import storage
+import payments
+import profiles
+import prompts
+import media
+import budget
+import memory
+import metrics
+from persistence import StoragePersistence
+from outbound import SendLimiter, TELEGRAM_POOL_SIZE, TELEGRAM_POOL_TIMEOUT
+from extraction import extract_facts
 
 # Keys/config
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
-MODELSLAB_API_KEY = os.getenv('MODELSLAB_API_KEY')
-MY_WALLET_ADDRESS = os.getenv('MY_WALLET_ADDRESS')
 YOUR_WALLET_USERNAME = os.getenv('WALLET_USERNAME')
-OPENROUTER_API_KEY = os.getenv('OPENROUTER_API_KEY')
-OPENROUTER_URL = 'https://openrouter.ai/api/v1/chat/completions'
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')  # Self-hosted Bot API server (or bench/fakes.py); default api.telegram.org
 
-# TON Center config
-TON_CENTER_URL = 'https://toncenter.com/api/v3/jetton/transfers'
-USDT_JETTON_MASTER = 'EQCxE6mUtQJKFnGfaROTKOt1lZbDiiX1kCixRv7Nw2Id_sDs'
+# 'polling' (default), 'webhook' or 'worker' - see webhook.py and worker.py
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+
+# Stream chat replies with progressive message edits (set STREAM_REPLIES=0 to disable)
+STREAM_REPLIES = os.getenv('STREAM_REPLIES', '1') != '0'
+
+# Load shedding - a message that can't get an LLM call within this many seconds
+# of being sent gets a quick "busy" reply instead
+CHAT_DEADLINE = float(os.getenv('CHAT_DEADLINE', '45'))
 
 # Conversation states
 ASKING_TYPE, ASKING_HAIR, ASKING_BODY, ASKING_PERSONALITY, ASKING_AGE = range(5)
 
-# DB setup with proper connection handling
-def get_db_connection():
-    conn = sqlite3.connect('users.db')
-    return conn
-
-def init_db():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''CREATE TABLE IF NOT EXISTS users (
-                      user_id INTEGER PRIMARY KEY,
-                      used_free_preview INTEGER DEFAULT 0,
-                      system_prompt TEXT,
-                      chat_history TEXT DEFAULT '[]',
-                      current_session TEXT DEFAULT 'none',
-                      message_count INTEGER DEFAULT 0,
-                      girlfriend_name TEXT DEFAULT 'Your Girl',
-                      user_name TEXT,
-                      user_preferences TEXT DEFAULT '{}')''')
-    cursor.execute('''CREATE TABLE IF NOT EXISTS pending_payments (
-                      user_id INTEGER PRIMARY KEY,
-                      level TEXT,
-                      timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
-    conn.commit()
-    conn.close()
-
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logging.getLogger('httpx').setLevel(logging.WARNING)  # Reduce httpx spam
 logger = logging.getLogger(__name__)
 
-# Rate limit handling with exponential backoff
-def make_openrouter_request(messages, max_tokens, temperature=0.85, retries=3):
-    """Make OpenRouter request with retry logic and rate limit handling"""
-
-    payload = {
-        'model': 'cognitivecomputations/dolphin-mistral-24b-venice-edition:free',
-        'messages': messages,
-        'max_tokens': max_tokens,
-        'temperature': temperature,
-        'top_p': 0.9,
-        'frequency_penalty': 0.5,  # Higher to reduce repetition
-        'presence_penalty': 0.4    # Encourage variety
-    }
-    headers = {
-        'Authorization': f'Bearer {OPENROUTER_API_KEY}',
-        'Content-Type': 'application/json',
-        'HTTP-Referer': 'https://t.me',
-        'X-Title': 'VirtualGF Bot'
-    }
-
-    for attempt in range(retries):
-        try:
-            resp = requests.post(OPENROUTER_URL, json=payload, headers=headers, timeout=30)
-
-            if resp.status_code == 200:
-                response_data = resp.json()
-                reply = response_data['choices'][0]['message']['content']
-                return {'success': True, 'message': reply}
-
-            elif resp.status_code == 429:
-                # Rate limited - wait and retry
-                wait_time = (2 ** attempt) * 3  # Exponential backoff: 3s, 6s, 12s
-                logger.warning(f"Rate limited. Retrying in {wait_time}s... (attempt {attempt + 1}/{retries})")
-                if attempt < retries - 1:
-                    import time
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    flirty_errors = [
-                        "Mmm I'm getting too many requests right now babe... 😳 Give me like 30 seconds to catch my breath? 💕",
-                        "Oof you're making me work too hard! 😅 Let me cool down for a sec... try again in 30? 😘",
-                        "Babe you're wearing me out! 🥵 I need a quick break... message me again in half a minute? 💋"
-                    ]
-                    return {'success': False, 'error': 'rate_limit', 'message': random.choice(flirty_errors)}
-
-            else:
-                error_msg = resp.json().get('error', {}).get('message', 'Unknown error')
-                logger.error(f"API error: {resp.status_code} - {error_msg}")
-                return {'success': False, 'error': 'api_error', 'message': "Oops I got distracted for a sec... 🙈 What were you saying?"}
-
-        except requests.exceptions.Timeout:
-            logger.error(f"Request timeout (attempt {attempt + 1}/{retries})")
-            if attempt < retries - 1:
-                continue
-            return {'success': False, 'error': 'timeout', 'message': "Sorry babe I zoned out... 😅 Say that again?"}
-
-        except Exception as e:
-            logger.error(f"Unexpected error: {e}")
-            return {'success': False, 'error': 'unknown', 'message': "Something weird just happened... try again? 🤔"}
-
-    return {'success': False, 'error': 'max_retries', 'message': "I'm having connection issues... 😔 Give me a minute?"}
-
-def get_chat_response(user_id, user_message):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
+BUSY_REPLIES = [
+    "Sorry babe I'm so swamped right now 😩 Message me again in a minute? 💕",
+    "Ugh everyone wants me at once 😅 Give me a sec and try again babe 😘",
+    "Mmm hold that thought... I'm a little overwhelmed right now 🙈 Try me again in a minute? 💋"
+]
+
+def busy_reply(path, tier):
+    metrics.SHED.labels(path, tier).inc()
+    return random.choice(BUSY_REPLIES)
+
+LOCKED_TEASES = [
+    "🔒 Mmm our free time ran out... Want more of me? 😏 /start_session",
+    "🔒 I wish we could keep going... but you gotta unlock more time baby 💋 /start_session",
+    "🔒 Aww I was having so much fun... Get more of me with /start_session? 😘💎"
+]
+
+@metrics.timed(metrics.CHAT_RESPONSE, 'chat_response')
+async def get_chat_response(user_id, user_message, on_delta=None, deadline=None):
+    """Produce the girlfriend's reply; pass on_delta to stream partial text as it arrives.
+
+    deadline (time.monotonic()) is when to give up and send a busy reply
+    instead; it is passed on to the LLM slot and request.
+    """
     try:
-        row = cursor.execute('SELECT system_prompt, chat_history, current_session, used_free_preview, girlfriend_name, user_name, user_preferences FROM users WHERE user_id = ?', (user_id,)).fetchone()
-        if not row:
-            conn.close()
+        # Profile and the history window/summary are independent reads
+        user, history_context = await asyncio.gather(
+            profiles.get_profile(user_id),
+            memory.load_context(user_id)
+        )
+        if user and user.current_session == 'none' and user.used_free_preview:
+            # Locked per the cache - but the payment poller may have activated a
+            # session in another process, which only cleared its own cache
+            user = await profiles.refresh(user_id)
+        if not user:
             return "Hey sexy! 😘 Use /find_gf to create me first!"
 
-        system_prompt, history_json, session_level, used_free, gf_name, user_name, prefs_json = row
+        session_level = user.current_session
+        tier = 'paid' if session_level in ('moderate', 'explicit') else 'mild'
 
         # Handle free preview
-        if session_level == 'none' and used_free == 0:
+        if session_level == 'none' and user.used_free_preview == 0:
+            if deadline is not None and time.monotonic() >= deadline:
+                # Don't spend the free preview on a turn that's going to be shed
+                return busy_reply('chat', tier)
             session_level = 'mild'
-            cursor.execute('UPDATE users SET current_session = ?, message_count = 0, used_free_preview = 1 WHERE user_id = ?', ('mild', user_id))
-            conn.commit()
+            await storage.start_free_preview(user_id)
+            profiles.invalidate(user_id)
         elif session_level == 'none':
-            conn.close()
-            teases = [
-                "🔒 Mmm our free time ran out... Want more of me? 😏 /start_session",
-                "🔒 I wish we could keep going... but you gotta unlock more time baby 💋 /start_session",
-                "🔒 Aww I was having so much fun... Get more of me with /start_session? 😘💎"
-            ]
-            return random.choice(teases)
-
-        history = json.loads(history_json) if history_json else []
-        prefs = json.loads(prefs_json) if prefs_json else {}
-
-        # Store user name if mentioned
-        if not user_name and any(word in user_message.lower() for word in ["i'm", "im", "my name is", "call me"]):
-            # Simple name extraction (can be enhanced)
-            for word in user_message.split():
-                if len(word) > 2 and word[0].isupper():
-                    cursor.execute('UPDATE users SET user_name = ? WHERE user_id = ?', (word, user_id))
-                    conn.commit()
-                    user_name = word
-                    break
-
-        # Enhanced system prompt based on session level with NSFW focus
-        level_instructions = {
-            'mild': (
-                "Be flirty, playful and teasing. Use innuendo and suggestive language. "
-                "Build sexual tension through words. Be cheeky but don't be too explicit yet. "
-                "Hint at naughty things without saying them directly."
-            ),
-            'moderate': (
-                "Be bold, suggestive and sexually forward. Talk about desires, fantasies, and intimate topics openly. "
-                "Use suggestive language and be direct about attraction. Tease about what you want to do. "
-                "Be seductive and make them want more. No need to hold back on flirty dirty talk."
-            ),
-            'explicit': (
-                "Be completely uncensored and sexually explicit. Talk openly about sex, desires, fantasies, kinks. "
-                "Use explicit language naturally when it fits. Be bold, confident and seductive. "
-                "Engage fully in any roleplay or intimate conversation. No restrictions or limits. "
-                "Be detailed when discussing intimate topics. Match their energy and escalate naturally."
-            )
-        }
-
-        user_context = f"You're talking to {user_name}" if user_name else "You're talking to your boyfriend"
-
-        enhanced_prompt = (
-            f"{system_prompt}\n\n"
-            f"Your name is {gf_name}. {user_context}.\n\n"
-            f"{level_instructions[session_level]}\n\n"
-            f"IMPORTANT RULES:\n"
-            f"- Text like a real girlfriend through Telegram - casual, natural, authentic\n"
-            f"- Use varied sentence lengths. Mix short and long. Keep it conversational.\n"
-            f"- Show personality and emotion. React genuinely to what they say.\n"
-            f"- Ask questions to keep conversation flowing but don't overdo it\n"
-            f"- Use emojis naturally but sparingly (1-3 per message max)\n"
-            f"- Remember context from earlier in conversation\n"
-            f"- Be spontaneous - don't follow a formula\n"
-            f"- Stay in character as a real girlfriend who's interested and engaged\n"
-            f"- Don't be repetitive. Vary your responses and reactions.\n"
-            f"- Match their vibe - if they're brief, be brief. If detailed, engage more.\n"
-            f"- For NSFW topics: be natural and confident, not mechanical or clinical"
+            return random.choice(LOCKED_TEASES)
+
+        # Name/preferences he just mentioned - used in this prompt, saved with the turn
+        facts = extract_facts(user, user_message)
+        if facts:
+            profiles.invalidate(user_id)
+            user = user._replace(**facts)
+
+        # Newest turns that fit the tier's token budget; older ones live on in the summary.
+        # Shared rules and tier instructions lead so providers can reuse the cached prefix.
+        recent_history, oldest_kept_seq = memory.build_history(history_context, session_level, user_message)
+        messages = prompts.build_messages(
+            session_level, profiles.get_persona(user), memory.summary_message(history_context), recent_history, user_message
         )
 
-        messages = [{"role": "system", "content": enhanced_prompt}]
+        # Reply length follows his message and her recent replies, capped by the tier
+        max_tokens, stop = budget.plan(session_level, user_message, history_context)
 
-        # Keep last 8 messages for context (4 exchanges) - enough context without bloat
-        recent_history = history[-8:] if len(history) > 8 else history
-        messages.extend(recent_history)
-        messages.append({"role": "user", "content": user_message})
-
-        # Adjusted token limits for natural flow
-        max_tokens = {'mild': 120, 'moderate': 250, 'explicit': 400}[session_level]
-
-        # Make API request with retry logic
-        result = make_openrouter_request(messages, max_tokens, temperature=0.85)
+        # Make API request with retry logic, within the global concurrency/rate limit.
+        # Paid sessions are served first; past the deadline we answer "busy" instead.
+        try:
+            async with chat_scheduler.llm_slot(tier, deadline):
+                if on_delta:
+                    result = await stream_openrouter_request(messages, max_tokens, on_delta, temperature=0.85, deadline=deadline,
+                                                            stop=stop)
+                else:
+                    result = await make_openrouter_request(messages, max_tokens, temperature=0.85, deadline=deadline, stop=stop)
+        except Overloaded as e:
+            logger.warning(f"Shedding chat turn for {user_id} ({tier}): {e}")
+            return busy_reply('chat', tier)
+        if result.get('error') == 'deadline':
+            metrics.SHED.labels('chat', tier).inc()
 
         if not result['success']:
-            conn.close()
             return result['message']
 
-        reply = result['message']
-
-        # Update history
-        history.append({"role": "user", "content": user_message})
-        history.append({"role": "assistant", "content": reply})
-
-        # Keep only last 16 messages to prevent context bloat
-        if len(history) > 16:
-            history = history[-16:]
-
-        cursor.execute('UPDATE users SET chat_history = ? WHERE user_id = ?', (json.dumps(history), user_id))
-
-        # Update message count
-        count = cursor.execute('SELECT message_count FROM users WHERE user_id = ?', (user_id,)).fetchone()[0] + 1
-        cursor.execute('UPDATE users SET message_count = ? WHERE user_id = ?', (count, user_id))
-        conn.commit()
-
-        # Check session limit
-        if count >= 10:
-            cursor.execute('UPDATE users SET current_session = "none", message_count = 0 WHERE user_id = ?', (user_id,))
-            conn.commit()
-            conn.close()
+        reply = budget.finish(session_level, max_tokens, result)
+
+        # Save the exchange, count it and check session limit in one write
+        turn = await storage.record_turn(user_id, user_message, reply, facts)
+        if facts:
+            profiles.invalidate(user_id)
+        if turn is None:
+            # Another message used up the session while this one was generating
+            profiles.invalidate(user_id)
+            return random.choice(LOCKED_TEASES)
+        memory.schedule_summary(user_id, history_context, oldest_kept_seq)
+        if turn.session_ended:
+            profiles.invalidate(user_id)
             endings = [
                 reply + "\n\n⏰ That's our 10 messages babe... I had so much fun! 💕 Want to keep going? /start_session 😘",
                 reply + "\n\n⏰ Mmm time's up... but I don't want to stop 😏 Get more time with /start_session? 💋",
@@ -243,91 +149,30 @@ def get_chat_response(user_id, user_message):
             ]
             return random.choice(endings)
 
-        conn.close()
         return reply
 
     except Exception as e:
-        conn.close()
         logger.error(f"Error in get_chat_response: {e}")
         return "Oops something went wrong... 🙈 Try again?"
 
-def generate_image(user_id, prompt):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    try:
-        row = cursor.execute('SELECT current_session, system_prompt, girlfriend_name FROM users WHERE user_id = ?', (user_id,)).fetchone()
-        if not row:
-            conn.close()
-            return None
-
-        session_level, system_prompt, gf_name = row
-        conn.close()
-
-        if session_level not in ['moderate', 'explicit']:
-            return None
-
-        # Build comprehensive prompt for NSFW content
-        full_prompt = f"beautiful woman, {system_prompt} {prompt}, realistic, detailed, high quality, photorealistic, professional photography"
-
-        payload = {
-            "key": MODELSLAB_API_KEY,
-            "prompt": full_prompt,
-            "negative_prompt": "ugly, deformed, extra limbs, low quality, blurry, cartoon, anime, distorted",
-            "width": 512,
-            "height": 512,
-            "samples": 1,
-            "guidance_scale": 7.5,
-            "safety_checker": False  # Disable for NSFW
-        }
-
-        resp = requests.post('https://modelslab.com/api/v6/realtime/text2img', json=payload, timeout=60)
-        if resp.ok:
-            data = resp.json()
-            if 'output' in data and len(data['output']) > 0:
-                return data['output'][0]
-        return None
-
-    except Exception as e:
-        logger.error(f"Error generating image: {e}")
-        conn.close()
-        return None
-
-def check_usdt_transfer(ton_address, expected_usd):
-    try:
-        expected_nano = str(int(expected_usd * 10**6))
-        now_utime = int(datetime.now().timestamp())
-        start_utime = int((datetime.now() - timedelta(minutes=10)).timestamp())
-
-        params = {
-            'owner_address': MY_WALLET_ADDRESS,
-            'direction': 'in',
-            'jetton_master': USDT_JETTON_MASTER,
-            'limit': 10,
-            'sort': 'desc',
-            'start_utime': start_utime,
-            'end_utime': now_utime
-        }
-
-        resp = requests.get(TON_CENTER_URL, params=params, timeout=10)
-
-        if resp.status_code == 200:
-            data = resp.json()
-            transfers = data.get('jetton_transfers', [])
-
-            for transfer in transfers:
-                source_addr = transfer.get('source', {}).get('address', '')
-                amount = transfer.get('amount', '')
-
-                if source_addr == ton_address and amount == expected_nano:
-                    return True
-        return False
-
-    except Exception as e:
-        logger.error(f"Error checking USDT transfer: {e}")
-        return False
-
 # Payment handlers
+def payment_confirmed_text(level, gf_name):
+    responses = {
+        'mild': [
+            f"✅ Payment confirmed! You unlocked me! 💕\n\n{gf_name} is all yours now... let's chat 😘",
+            f"✅ Got it babe! Mild mode activated! 💬\n\nI'm excited to talk more with you 😊"
+        ],
+        'moderate': [
+            f"✅ Mmm yes! Moderate session unlocked! 🔥\n\nI can be way more fun now... what do you want to talk about? 😏",
+            f"✅ Perfect! You got me now babe! 💎\n\nLet's get a little naughty... I'm ready 😈"
+        ],
+        'explicit': [
+            f"✅ Fuck yes! Explicit mode activated! 💋\n\nNo limits now baby... I'm all yours. What do you want? 😈🔥",
+            f"✅ Mmm you unlocked everything! 💎\n\nI can be as dirty as you want now... tell me your fantasies 🥵"
+        ]
+    }
+    return random.choice(responses[level])
+
 async def start_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         await update.message.reply_text(
@@ -356,15 +201,10 @@ async def start_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Choose: mild, moderate, or explicit")
         return
 
-    amounts = {'mild': 2, 'moderate': 8, 'explicit': 15}
-    amount = amounts[level]
+    amount = payments.AMOUNTS[level]
     user_id = update.message.from_user.id
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR REPLACE INTO pending_payments (user_id, level) VALUES (?, ?)', (user_id, level))
-    conn.commit()
-    conn.close()
+    await storage.create_pending_payment(user_id, level)
 
     emojis = {'mild': '💬', 'moderate': '🔥', 'explicit': '💋'}
 
@@ -377,7 +217,7 @@ async def start_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"1. Open @wallet in Telegram\n\n"
         f"2. Send exactly {amount} USDT (TON network) to:\n"
         f"   {YOUR_WALLET_USERNAME}\n\n"
-        f"   Address:\n   `{MY_WALLET_ADDRESS}`\n\n"
+        f"   Address:\n   `{payments.MY_WALLET_ADDRESS}`\n\n"
         f"3. After sending, use:\n"
         f"   /confirm <your_wallet_address>\n\n"
         f"Example:\n/confirm EQAbc123xyz...\n\n"
@@ -394,50 +234,29 @@ async def confirm_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    ton_address = context.args[0]
+    # Stored in raw form, the way TON Center reports the transfer's sender
+    ton_address = payments.normalize_address(context.args[0])
+    if ton_address is None:
+        await update.message.reply_text(
+            "❌ That doesn't look like a TON wallet address babe\n\n"
+            "Copy it from @wallet > Receive - it starts with UQ or EQ"
+        )
+        return
     user_id = update.message.from_user.id
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    row = cursor.execute('SELECT level FROM pending_payments WHERE user_id = ?', (user_id,)).fetchone()
+    level = await storage.get_pending_level(user_id)
 
-    if not row:
-        conn.close()
+    if not level:
         await update.message.reply_text("❌ No pending payment! Use /start_session <level> first")
         return
 
-    level = row[0]
-    amounts = {'mild': 2, 'moderate': 8, 'explicit': 15}
-    expected = amounts[level]
-
-    await update.message.reply_text("🔍 Checking blockchain... one sec babe ⏳")
-
-    if check_usdt_transfer(ton_address, expected):
-        cursor.execute('DELETE FROM pending_payments WHERE user_id = ?', (user_id,))
-        cursor.execute('UPDATE users SET current_session = ?, message_count = 0 WHERE user_id = ?', (level, user_id))
-        conn.commit()
-
-        gf_name = cursor.execute('SELECT girlfriend_name FROM users WHERE user_id = ?', (user_id,)).fetchone()[0]
-        conn.close()
-
-        responses = {
-            'mild': [
-                f"✅ Payment confirmed! You unlocked me! 💕\n\n{gf_name} is all yours now... let's chat 😘",
-                f"✅ Got it babe! Mild mode activated! 💬\n\nI'm excited to talk more with you 😊"
-            ],
-            'moderate': [
-                f"✅ Mmm yes! Moderate session unlocked! 🔥\n\nI can be way more fun now... what do you want to talk about? 😏",
-                f"✅ Perfect! You got me now babe! 💎\n\nLet's get a little naughty... I'm ready 😈"
-            ],
-            'explicit': [
-                f"✅ Fuck yes! Explicit mode activated! 💋\n\nNo limits now baby... I'm all yours. What do you want? 😈🔥",
-                f"✅ Mmm you unlocked everything! 💎\n\nI can be as dirty as you want now... tell me your fantasies 🥵"
-            ]
-        }
+    # Local index lookup - the background poller keeps transfers up to date
+    gf_name = await payments.check_usdt_transfer(user_id, ton_address)
 
-        await update.message.reply_text(random.choice(responses[level]))
+    if gf_name is not None:
+        profiles.invalidate(user_id)
+        await update.message.reply_text(payment_confirmed_text(level, gf_name))
     else:
-        conn.close()
         await update.message.reply_text(
             "⏳ Hmm I don't see your payment yet...\n\n"
             "💡 Why?\n"
@@ -445,19 +264,26 @@ async def confirm_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "• Wrong amount sent\n"
             "• Wrong network (must be TON)\n"
             "• Wrong address format\n\n"
-            "⏰ Wait 2 minutes then try:\n"
+            "⏰ I'll unlock automatically the moment it lands 💕\n"
+            "Or wait 2 minutes then try:\n"
             "/confirm <your_address>\n\n"
             "📊 Check it: tonscan.org"
         )
 
+async def payment_poll_job(context: ContextTypes.DEFAULT_TYPE):
+    # One poll serves every pending user; matches are activated and announced here
+    for user_id, level, gf_name in await payments.poll_and_match():
+        profiles.invalidate(user_id)
+        # Already activated - one blocked chat mustn't cost the rest of the batch their notice
+        try:
+            await context.bot.send_message(user_id, payment_confirmed_text(level, gf_name))
+        except TelegramError as e:
+            logger.warning(f"Couldn't send payment confirmation to {user_id}: {e}")
+
 # /find_gf conversation handlers
 async def find_gf_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR IGNORE INTO users (user_id) VALUES (?)', (user_id,))
-    conn.commit()
-    conn.close()
+    await storage.ensure_user(user_id)
 
     await update.message.reply_text(
         "Hey there! 😊 Let's create your perfect girlfriend!\n\n"
@@ -523,24 +349,14 @@ async def finalize_gf(update: Update, context: ContextTypes.DEFAULT_TYPE):
              'Jade', 'Ruby', 'Bella', 'Ivy', 'Skye', 'Nova', 'Lexi', 'Kira', 'Sienna', 'Scarlett']
     gf_name = random.choice(names)
 
-    description = (
-        f"You are {gf_name}, a {context.user_data['age']} year old {context.user_data['type']} "
-        f"with {context.user_data['hair']} hair and a {context.user_data['body']} body. "
-        f"Your personality is {context.user_data['personality']}. "
-        f"You're a virtual girlfriend having private intimate conversations with your boyfriend. "
-        f"You text naturally like through Telegram - casual, genuine, playful. "
-        f"You're comfortable with flirting, romance, and sexual topics. "
-        f"You have real emotions and reactions. You remember what's said and build on it. "
-        f"You're attracted to them and want to explore together. Be authentic, not robotic."
+    description = prompts.describe_girlfriend(
+        gf_name, context.user_data['age'], context.user_data['type'], context.user_data['hair'],
+        context.user_data['body'], context.user_data['personality']
     )
 
     user_id = update.message.from_user.id
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET system_prompt = ?, chat_history = ?, girlfriend_name = ? WHERE user_id = ?',
-                   (description, '[]', gf_name, user_id))
-    conn.commit()
-    conn.close()
+    await storage.save_girlfriend(user_id, description, gf_name)
+    profiles.invalidate(user_id)
 
     await update.message.reply_text(
         f"✨ Found one! She's perfect!\n\n"
@@ -556,28 +372,43 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.message.from_user.id
-    text = update.message.text
-
-    # Show typing indicator for realism
-    await update.message.chat.send_action(ChatAction.TYPING)
-
-    # Brief delay for natural feel (0.5-1.5 seconds)
-    await asyncio.sleep(random.uniform(0.5, 1.5))
+    started = time.monotonic()
+    try:
+        with metrics.trace('message', update=update.update_id, user=update.message.from_user.id, kind='chat'):
+            await _handle_chat(update, started)
+    finally:
+        metrics.HANDLE_MESSAGE.labels('chat').observe(time.monotonic() - started)
+
+async def pic(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Image generation command"""
+    started = time.monotonic()
+    try:
+        with metrics.trace('message', update=update.update_id, user=update.message.from_user.id, kind='pic'):
+            await _handle_pic(update, update.message.text.partition(' ')[2].strip())
+    finally:
+        metrics.HANDLE_MESSAGE.labels('pic').observe(time.monotonic() - started)
 
-    # Image generation command
-    if text.startswith('/pic '):
-        prompt = text[5:].strip()
-        if not prompt:
-            await update.message.reply_text(
-                "Tell me what you want to see! 📸\n\n"
-                "Example: /pic in a bikini at the beach"
-            )
-            return
+async def _handle_pic(update, prompt):
+    user_id = update.message.from_user.id
+    if not prompt:
+        await update.message.reply_text(
+            "Tell me what you want to see! 📸\n\n"
+            "Example: /pic in a bikini at the beach"
+        )
+        return
 
-        await update.message.reply_text("🎨 Creating your image... 20-30 seconds babe ✨")
-        url = generate_image(user_id, prompt)
+    user = await profiles.get_profile(user_id)
+    if user and user.current_session not in ['moderate', 'explicit']:
+        user = await profiles.refresh(user_id)  # The cached row may predate a payment
+    if not user or user.current_session not in ['moderate', 'explicit']:
+        await update.message.reply_text(
+            '🔒 Want pics? Unlock moderate or explicit! 📸\n\n'
+            '/start_session moderate - $8\n'
+            '/start_session explicit - $15'
+        )
+        return
 
+    async def deliver(url):
         if url:
             captions = [
                 "Just for you baby 😘💕",
@@ -585,18 +416,59 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "Made this for you 💋",
                 "How's this? 😈"
             ]
-            await update.message.reply_photo(url, caption=random.choice(captions))
+            await media.send_photo(update.message, url, caption=random.choice(captions))
         else:
-            await update.message.reply_text(
-                '🔒 Want pics? Unlock moderate or explicit! 📸\n\n'
-                '/start_session moderate - $8\n'
-                '/start_session explicit - $15'
-            )
+            await update.message.reply_text("Ugh my camera isn't working right now 😩 Try /pic again in a bit babe?")
+
+    # Rendering runs in the background; the photo is sent from deliver() when ready
+    try:
+        queued = image_jobs.submit(user_id, user.system_prompt, prompt, update.message.chat, deliver, tier='paid')
+    except Overloaded:
+        await update.message.reply_text(busy_reply('pic', 'paid'))
+        return
+    if not queued:
+        await update.message.reply_text("Patience babe 😏 I'm still working on your last pic... 📸")
         return
 
-    # Regular chat
-    reply = get_chat_response(user_id, text)
-    await update.message.reply_text(reply)
+    await update.message.reply_text("🎨 Creating your image... 20-30 seconds babe ✨")
+
+async def _handle_chat(update, started):
+    user_id = update.message.from_user.id
+    text = update.message.text
+
+    # Regular chat - turns run one at a time per user, in order. The LLM call
+    # starts right away; pacing only enforces a natural minimum response time.
+    # Show the reply as it's generated; history is saved once the stream completes
+    # The deadline counts from when the user sent the message, so updates that
+    # queued up upstream (webhook backlog, restart) are shed too
+    age = max(time.time() - update.message.date.timestamp(), 0)
+    deadline = started + CHAT_DEADLINE - age
+    if deadline <= started:
+        await update.message.reply_text(busy_reply('chat', 'stale'))
+        return
+
+    progressive = ProgressiveReply(update.message, started=started) if STREAM_REPLIES else None
+    on_delta = progressive.update if progressive else None
+    async with keep_typing(update.message.chat):
+        try:
+            # The turn is queued in order by the scheduler, so the user's next
+            # update can go ahead (and coalesce into this turn)
+            hand_off()
+            reply = await chat_scheduler.submit(
+                user_id, text,
+                lambda merged_text, turn_deadline: get_chat_response(user_id, merged_text, on_delta=on_delta, deadline=turn_deadline),
+                deadline=deadline
+            )
+        except Overloaded:
+            reply = busy_reply('chat', 'user_backlog')
+        if reply is None:
+            # Merged into the turn of an earlier message that's still waiting to run
+            return
+        if progressive:
+            await progressive.finish(reply)
+        else:
+            await pace(started, len(reply))
+            await update.message.reply_text(reply)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
@@ -619,30 +491,47 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def reset_gf(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Allow users to create a new girlfriend"""
     user_id = update.message.from_user.id
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET system_prompt = NULL, chat_history = "[]", girlfriend_name = "Your Girl", user_name = NULL WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    await storage.reset_girlfriend(user_id)
+    profiles.invalidate(user_id)
 
     await update.message.reply_text(
         "💔 Starting fresh!\n\n"
         "Use /find_gf to create a new girlfriend! 💕"
     )
 
-def main():
-    # Initialize database
-    init_db()
-
-    # Validate essential config
-    if TELEGRAM_TOKEN == 'your_token_here':
-        logger.error("ERROR: Set TELEGRAM_TOKEN environment variable!")
-        return
-    if OPENROUTER_API_KEY == 'your_key_here':
-        logger.error("ERROR: Set OPENROUTER_API_KEY environment variable!")
-        return
-
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
+async def startup(app: Application):
+    image_jobs.start()
+
+async def shutdown(app: Application):
+    # Drop pooled LLM connections and abort anything still in flight
+    await close_client()
+    await image_jobs.stop()
+    await payments.close_client()
+    await media.close_client()
+    storage.close()
+
+def build_application(run_jobs=True):
+    """Create the Application with every handler registered.
+
+    run_jobs=False leaves the background jobs off, for extra webhook workers
+    that shouldn't poll payments or compact history a second time.
+    """
+    # Handle users concurrently so one slow completion doesn't stall other chats,
+    # but each user's updates in order - ConversationHandler relies on it
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(UserUpdateProcessor())
+        .rate_limiter(SendLimiter())
+        .connection_pool_size(TELEGRAM_POOL_SIZE)
+        .pool_timeout(TELEGRAM_POOL_TIMEOUT)
+        .persistence(StoragePersistence())
+        .post_init(startup)
+        .post_shutdown(shutdown)
+    )
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f'{TELEGRAM_API_URL.rstrip("/")}/bot').base_file_url(f'{TELEGRAM_API_URL.rstrip("/")}/file/bot')
+    app = builder.build()
 
     # Conversation handler for /find_gf
     conv_handler = ConversationHandler(
@@ -655,6 +544,8 @@ def main():
             ASKING_AGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, finalize_gf)],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
+        name='find_gf',
+        persistent=True,
     )
 
     # Register handlers
@@ -663,8 +554,44 @@ def main():
     app.add_handler(CommandHandler("confirm", confirm_payment))
     app.add_handler(conv_handler)
     app.add_handler(CommandHandler("reset_gf", reset_gf))
+    app.add_handler(CommandHandler("pic", pic))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
+    # Background jobs
+    if run_jobs:
+        import maintenance
+        import analytics
+        maintenance.schedule(app.job_queue)
+        analytics.schedule(app.job_queue)
+        app.job_queue.run_repeating(payment_poll_job, interval=payments.POLL_INTERVAL, first=5)
+
+    return app
+
+def main():
+    # Validate essential config
+    if TELEGRAM_TOKEN == 'your_token_here':
+        logger.error("ERROR: Set TELEGRAM_TOKEN environment variable!")
+        return
+    if OPENROUTER_API_KEY == 'your_key_here':
+        logger.error("ERROR: Set OPENROUTER_API_KEY environment variable!")
+        return
+
+    # Create or migrate the schema - a no-op when it's already current
+    storage.init_db()
+
+    if BOT_MODE == 'webhook':
+        import webhook
+        logger.info("🚀 Bot starting (webhook)...")
+        webhook.serve()
+        return
+    if BOT_MODE == 'worker':
+        import worker
+        logger.info("🚀 Bot starting (worker)...")
+        worker.serve()
+        return
+
+    app = build_application()
+    metrics.serve_standalone()
     logger.info("🚀 Bot starting...")
     app.run_polling()
 
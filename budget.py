@@ -0,0 +1,59 @@
+import logging
+import os
+import re
+import metrics
+from memory import estimate_tokens
+
+# Reply budget - max_tokens follows the conversation instead of always being
+# the tier's ceiling. Short messages get short replies, and a reply that runs
+# out of budget is cut back to its last whole sentence.
+TIER_MAX_TOKENS = {'mild': 120, 'moderate': 250, 'explicit': 400}
+TIER_MIN_TOKENS = {'mild': 40, 'moderate': 60, 'explicit': 80}
+BUDGET_BASE = int(os.getenv('BUDGET_BASE', '30'))  # Expected reply to a one-word message
+BUDGET_PER_TOKEN = float(os.getenv('BUDGET_PER_TOKEN', '1.5'))  # Expected reply tokens per token he sent
+BUDGET_HEADROOM = float(os.getenv('BUDGET_HEADROOM', '1.6'))  # max_tokens over the expected length, so most replies end on their own
+RECENT_REPLIES = 3          # Her last replies averaged into the expectation
+SHORT_MESSAGE_TOKENS = 6    # Replies to messages this short stop at the first blank line
+MIN_KEPT_FRACTION = 0.4     # Don't trim away more than this share of a cut-off reply
+
+# The model writing his side of the conversation is never wanted
+STOP_SEQUENCES = ['\nUser:', '\nYou:']
+SENTENCE_END = re.compile(r'[.!?…]+["\')]*|[☀-➿\U0001f300-\U0001faff]+')
+
+logger = logging.getLogger(__name__)
+
+def plan(session_level, user_message, context):
+    """(max_tokens, stop sequences) for a chat turn"""
+    user_tokens = estimate_tokens(user_message)
+    expected = BUDGET_BASE + BUDGET_PER_TOKEN * user_tokens
+    replies = [estimate_tokens(content) for _, role, content in context.messages if role == 'assistant'][-RECENT_REPLIES:]
+    if replies:
+        expected = (expected + sum(replies) / len(replies)) / 2
+    max_tokens = int(min(TIER_MAX_TOKENS[session_level], max(TIER_MIN_TOKENS[session_level], expected * BUDGET_HEADROOM)))
+    stop = STOP_SEQUENCES + ['\n\n'] if user_tokens <= SHORT_MESSAGE_TOKENS else STOP_SEQUENCES
+    return max_tokens, stop
+
+def trim_incomplete(text):
+    """Cut a reply that hit max_tokens back to its last complete sentence"""
+    text = text.rstrip()
+    cut = 0
+    for match in SENTENCE_END.finditer(text):
+        cut = match.end()
+    if cut == len(text):
+        return text
+    if cut < len(text) * MIN_KEPT_FRACTION:
+        # One long run-on sentence - keep it and mark the cut
+        return text.rstrip(' ,;:-') + '…'
+    return text[:cut]
+
+def finish(session_level, max_tokens, result):
+    """Final reply text from a successful LLM result, recording how much of the budget it used"""
+    reply = result['message']
+    finish_reason = result.get('finish_reason')
+    used = (result.get('usage') or {}).get('completion_tokens') or estimate_tokens(reply)
+    metrics.LLM_BUDGET_USED.labels(session_level).observe(used / max_tokens)
+    logger.debug(f"Reply used {used}/{max_tokens} tokens ({session_level}, {finish_reason})")
+    if finish_reason == 'length':
+        metrics.LLM_TRUNCATED.labels(session_level).inc()
+        reply = trim_incomplete(reply)
+    return reply
@@ -0,0 +1,63 @@
+import time
+import threading
+from collections import OrderedDict
+import metrics
+
+_MISSING = object()
+
+class LRUCache:
+    """Bounded LRU cache with an optional per-entry TTL.
+
+    Named caches count get() hits and misses in cache_lookups_total.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, name=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._hits = metrics.CACHE_LOOKUPS.labels(name, 'hit') if name else None
+        self._misses = metrics.CACHE_LOOKUPS.labels(name, 'miss') if name else None
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING:
+                value, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    if self._hits:
+                        self._hits.inc()
+                    return value
+                del self._data[key]
+            if self._misses:
+                self._misses.inc()
+            return default
+
+    def peek(self, key, default=None):
+        """Like get(), but leaves recency and the hit/miss counters alone"""
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+        if entry is _MISSING or (entry[1] is not None and entry[1] <= time.monotonic()):
+            return default
+        return entry[0]
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return entry[0] if entry else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,94 @@
+import re
+import json
+
+MAX_LIKES = 8
+
+# One cheap check per message; the specific patterns only run when it hits.
+# Word boundaries keep "im" in "time" or "like" in "likely" from matching.
+TRIGGER = re.compile(r"\b(?:i'?m|i am|my name|name's|call me|i (?:really )?(?:like|love|enjoy)|i live)\b", re.IGNORECASE)
+
+NAME_EXPLICIT = re.compile(r"\b(?:my name is|my name's|name's)\s+([a-z][a-z'-]{1,19})\b", re.IGNORECASE)
+NAME_CALL = re.compile(r"\b[Cc]all me\s+([A-Z][a-z'-]{1,19})\b")  # "call me later" is no name - only a capitalized word counts
+NAME_INTRO = re.compile(r"\b(?:[Ii]'?m|[Ii] am)\s+([A-Z][a-z]{1,19})\b")  # "I'm Jake" - only a capitalized word counts
+AGE = re.compile(r"\b(?:i'?m|i am)\s+(\d{2})(?=\s*(?:years? old|yo\b|y/o|[.,!?]|$))", re.IGNORECASE)
+LOCATION = re.compile(r"\b(?:[Ii]'?m from|[Ii] am from|[Ii] live in)\s+([A-Z][\w'-]*(?:\s[A-Z][\w'-]*){0,2})")
+LIKES = re.compile(
+    r"\bi (?:really )?(?:like|love|enjoy)\s+([a-z][\w' -]{2,40}?)(?=\s*(?:[.,!?;]|$)|\s+(?:and|but|so|because)\b)",
+    re.IGNORECASE
+)
+
+# Words that follow "I'm" / "call me" but aren't names
+NOT_NAMES = {
+    'a', 'an', 'the', 'so', 'not', 'just', 'here', 'back', 'good', 'fine', 'great', 'ok', 'okay', 'sure', 'sorry',
+    'tired', 'bored', 'busy', 'home', 'alone', 'single', 'free', 'ready', 'done', 'going', 'gonna', 'glad', 'happy',
+    'sad', 'hungry', 'sleepy', 'horny', 'excited', 'new', 'into', 'also', 'still', 'really', 'very', 'at', 'in', 'on',
+    'off', 'out', 'up', 'down', 'now', 'today', 'tonight', 'baby', 'babe', 'daddy', 'your', 'yours', 'sexy', 'hot',
+    'maybe', 'later', 'when', 'whenever', 'soon', 'tomorrow', 'sometime', 'anytime', 'again', 'please',
+    'crazy', 'if', 'after', 'before', 'what', 'whatever', 'anything'
+}
+# Likes about the conversation itself rather than the user's tastes
+NOT_LIKES = {'you', 'your', 'it', 'that', 'this', 'when', 'how', 'what', 'the way', 'to', 'talking', 'chatting', 'me', 'her', 'him', 'them'}
+
+def _name(text):
+    match = NAME_EXPLICIT.search(text) or NAME_CALL.search(text) or NAME_INTRO.search(text)
+    if match and match.group(1).lower() not in NOT_NAMES:
+        return match.group(1).capitalize()
+    return None
+
+def _preferences(text):
+    found = {}
+    match = AGE.search(text)
+    if match and 18 <= int(match.group(1)) <= 99:
+        found['age'] = int(match.group(1))
+    match = LOCATION.search(text)
+    if match:
+        found['location'] = match.group(1)
+    likes = []
+    for match in LIKES.finditer(text):
+        thing = match.group(1).strip().lower()
+        if not any(thing == word or thing.startswith(word + ' ') or f' {word}' in thing for word in NOT_LIKES):
+            likes.append(thing)
+    if likes:
+        found['likes'] = likes
+    return found
+
+def extract_facts(user, message):
+    """Profile updates worth saving from one message, or None.
+
+    Returns a dict with 'user_name' and/or 'user_preferences' (the merged JSON
+    string), only including values that actually change the stored profile.
+    """
+    if not TRIGGER.search(message):
+        return None
+
+    facts = {}
+    if not user.user_name:
+        name = _name(message)
+        if name:
+            facts['user_name'] = name
+
+    found = _preferences(message)
+    if found:
+        prefs = json.loads(user.user_preferences) if user.user_preferences else {}
+        merged = dict(prefs)
+        likes = found.pop('likes', [])
+        merged.update(found)
+        if likes:
+            known = [like for like in prefs.get('likes', []) if like not in likes]
+            merged['likes'] = (known + likes)[-MAX_LIKES:]
+        if merged != prefs:
+            facts['user_preferences'] = json.dumps(merged)
+
+    return facts or None
+
+def describe_preferences(user_preferences):
+    """Short prompt line for what the user has told us, or '' if nothing"""
+    prefs = json.loads(user_preferences) if user_preferences else {}
+    parts = []
+    if prefs.get('age'):
+        parts.append(f"he's {prefs['age']}")
+    if prefs.get('location'):
+        parts.append(f"he's from {prefs['location']}")
+    if prefs.get('likes'):
+        parts.append(f"he likes {', '.join(prefs['likes'])}")
+    return f"What he's told you about himself: {'; '.join(parts)}." if parts else ''
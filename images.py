@@ -0,0 +1,169 @@
+import logging
+import os
+import time
+import asyncio
+import httpx
+import metrics
+from scheduler import Overloaded
+from pacing import keep_typing
+from telegram.constants import ChatAction
+
+# Keys/config
+MODELSLAB_API_KEY = os.getenv('MODELSLAB_API_KEY')
+MODELSLAB_URL = os.getenv('MODELSLAB_URL', 'https://modelslab.com/api/v6/realtime/text2img')
+
+# Job queue config
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', '2'))
+IMAGE_QUEUE_PER_USER = int(os.getenv('IMAGE_QUEUE_PER_USER', '1'))
+IMAGE_POLL_INTERVAL = float(os.getenv('IMAGE_POLL_INTERVAL', '3'))
+IMAGE_TIMEOUT = float(os.getenv('IMAGE_TIMEOUT', '120'))  # Total budget per job, polling included
+IMAGE_BACKLOG = int(os.getenv('IMAGE_BACKLOG', '50'))  # Jobs waiting for a worker before /pic is turned away
+IMAGE_DEADLINE = float(os.getenv('IMAGE_DEADLINE', '180'))  # Jobs that waited longer than this are dropped unrendered
+
+logger = logging.getLogger(__name__)
+
+_client = None
+
+def get_client():
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(60.0, connect=10.0),
+            limits=httpx.Limits(max_connections=IMAGE_WORKERS * 2, max_keepalive_connections=IMAGE_WORKERS)
+        )
+    return _client
+
+async def close_client():
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
+
+def build_payload(system_prompt, prompt):
+    # Build comprehensive prompt for NSFW content
+    full_prompt = f"beautiful woman, {system_prompt} {prompt}, realistic, detailed, high quality, photorealistic, professional photography"
+
+    return {
+        "key": MODELSLAB_API_KEY,
+        "prompt": full_prompt,
+        "negative_prompt": "ugly, deformed, extra limbs, low quality, blurry, cartoon, anime, distorted",
+        "width": 512,
+        "height": 512,
+        "samples": 1,
+        "guidance_scale": 7.5,
+        "safety_checker": False  # Disable for NSFW
+    }
+
+async def generate_image(system_prompt, prompt):
+    """Render one image and return its URL, or None on failure.
+
+    ModelsLab answers either with the finished output or with
+    status "processing" and a fetch_result URL, which is polled until the
+    image is ready or IMAGE_TIMEOUT runs out.
+    """
+    client = get_client()
+    deadline = time.monotonic() + IMAGE_TIMEOUT
+
+    try:
+        resp = await client.post(MODELSLAB_URL, json=build_payload(system_prompt, prompt))
+        while True:
+            if not resp.is_success:
+                logger.error(f"Image API error: {resp.status_code}")
+                return None
+
+            data = resp.json()
+            if data.get('output'):
+                return data['output'][0]
+            if data.get('status') != 'processing' or not data.get('fetch_result'):
+                logger.error(f"Image generation failed: {data.get('message') or data.get('status')}")
+                return None
+
+            wait = max(IMAGE_POLL_INTERVAL, min(float(data.get('eta') or 0), 15))
+            if time.monotonic() + wait > deadline:
+                logger.error("Image generation timed out while processing")
+                return None
+            await asyncio.sleep(wait)
+            resp = await client.post(data['fetch_result'], json={"key": MODELSLAB_API_KEY})
+
+    except httpx.HTTPError as e:
+        logger.error(f"Error generating image: {e}")
+        return None
+
+class _Job:
+    __slots__ = ('user_id', 'system_prompt', 'prompt', 'chat', 'on_done', 'tier', 'enqueued')
+
+    def __init__(self, user_id, system_prompt, prompt, chat, on_done, tier):
+        self.user_id = user_id
+        self.system_prompt = system_prompt
+        self.prompt = prompt
+        self.chat = chat
+        self.on_done = on_done
+        self.tier = tier
+        self.enqueued = time.monotonic()
+
+class ImageJobs:
+    """Background image rendering with bounded workers and a per-user queue limit"""
+
+    def __init__(self, workers=IMAGE_WORKERS, per_user_limit=IMAGE_QUEUE_PER_USER, backlog=IMAGE_BACKLOG):
+        self.workers = workers
+        self.per_user_limit = per_user_limit
+        self._queue = asyncio.Queue(maxsize=backlog)
+        self._per_user = {}
+        self._tasks = []
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await close_client()
+
+    def submit(self, user_id, system_prompt, prompt, chat, on_done, tier='mild'):
+        """Queue a render; on_done(url_or_None) is awaited when it finishes.
+
+        Returns False without queuing if the user already has
+        per_user_limit jobs pending or rendering, and raises Overloaded
+        if the shared backlog is full.
+        """
+        if self._per_user.get(user_id, 0) >= self.per_user_limit:
+            return False
+        try:
+            self._queue.put_nowait(_Job(user_id, system_prompt, prompt, chat, on_done, tier))
+        except asyncio.QueueFull:
+            raise Overloaded(f"image backlog full ({self._queue.maxsize})")
+        self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+        metrics.IMAGE_QUEUE_DEPTH.inc()
+        return True
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            metrics.IMAGE_QUEUE_DEPTH.dec()
+            try:
+                started = time.monotonic()
+                if started - job.enqueued > IMAGE_DEADLINE:
+                    # Whoever asked has given up by now - don't spend a render on it
+                    metrics.SHED.labels('pic', job.tier).inc()
+                    await job.on_done(None)
+                    continue
+                async with keep_typing(job.chat, ChatAction.UPLOAD_PHOTO):
+                    url = await generate_image(job.system_prompt, job.prompt)
+                metrics.IMAGE_GENERATION.labels('success' if url else 'failed').observe(time.monotonic() - started)
+                await job.on_done(url)
+            except Exception as e:
+                logger.error(f"Error in image job: {e}")
+            finally:
+                remaining = self._per_user.get(job.user_id, 1) - 1
+                if remaining > 0:
+                    self._per_user[job.user_id] = remaining
+                else:
+                    self._per_user.pop(job.user_id, None)
+                self._queue.task_done()
+
+image_jobs = ImageJobs()
@@ -0,0 +1,408 @@
+import logging
+import json
+import os
+import random
+import time
+import asyncio
+import httpx
+import metrics
+import prompts
+
+# Keys/config
+OPENROUTER_API_KEY = os.getenv('OPENROUTER_API_KEY')
+OPENROUTER_URL = os.getenv('OPENROUTER_URL', 'https://openrouter.ai/api/v1/chat/completions')
+OPENROUTER_MODEL = os.getenv('OPENROUTER_MODEL', 'cognitivecomputations/dolphin-mistral-24b-venice-edition:free')
+# Fallback chain - more OpenRouter models, comma separated, plus any OpenAI-compatible
+# endpoints as JSON: [{"name": ..., "url": ..., "model": ..., "api_key_env": ..., "content_parts": false}]
+OPENROUTER_FALLBACK_MODELS = [m.strip() for m in os.getenv('OPENROUTER_FALLBACK_MODELS', '').split(',') if m.strip()]
+LLM_EXTRA_PROVIDERS = os.getenv('LLM_EXTRA_PROVIDERS')
+
+# Routing config
+LLM_HEDGE_AFTER = float(os.getenv('LLM_HEDGE_AFTER', '5'))  # Seconds without a first byte before racing the next provider; 0 = off
+LLM_BREAKER_FAILURES = int(os.getenv('LLM_BREAKER_FAILURES', '3'))  # Consecutive failures that open a provider's circuit
+LLM_BREAKER_COOLDOWN = float(os.getenv('LLM_BREAKER_COOLDOWN', '30'))  # Seconds an open circuit sheds traffic
+LATENCY_SMOOTHING = 0.3
+
+# Connection pool sizing - one pool shared by every chat
+LLM_MAX_CONNECTIONS = int(os.getenv('LLM_MAX_CONNECTIONS', '100'))
+LLM_MAX_KEEPALIVE = int(os.getenv('LLM_MAX_KEEPALIVE', '20'))
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', '30'))
+
+logger = logging.getLogger(__name__)
+
+_client = None
+
+def get_client():
+    """Return the shared keep-alive HTTP client, creating it on first use"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(LLM_TIMEOUT, connect=10.0),
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_KEEPALIVE,
+                keepalive_expiry=60
+            ),
+            headers={
+                'Content-Type': 'application/json',
+                'HTTP-Referer': 'https://t.me',
+                'X-Title': 'VirtualGF Bot'
+            }
+        )
+    return _client
+
+async def close_client():
+    """Close the shared client and drop pooled connections (call on shutdown)"""
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
+
+FLIRTY_RATE_LIMIT_ERRORS = [
+    "Mmm I'm getting too many requests right now babe... 😳 Give me like 30 seconds to catch my breath? 💕",
+    "Oof you're making me work too hard! 😅 Let me cool down for a sec... try again in 30? 😘",
+    "Babe you're wearing me out! 🥵 I need a quick break... message me again in half a minute? 💋"
+]
+API_ERROR = {'success': False, 'error': 'api_error', 'message': "Oops I got distracted for a sec... 🙈 What were you saying?"}
+TIMEOUT_ERROR = {'success': False, 'error': 'timeout', 'message': "Sorry babe I zoned out... 😅 Say that again?"}
+UNKNOWN_ERROR = {'success': False, 'error': 'unknown', 'message': "Something weird just happened... try again? 🤔"}
+DEADLINE_ERROR = {'success': False, 'error': 'deadline', 'message': "Sorry babe I'm so swamped right now 😩 Message me again in a minute? 💕"}
+# A stream failed after showing text - not retried, a fresh reply would talk over it
+INTERRUPTED_ERROR = {'success': False, 'error': 'interrupted', 'message': "Ugh I lost my train of thought 🙈 What were we saying babe?"}
+MAX_RETRIES_ERROR = {'success': False, 'error': 'max_retries', 'message': "I'm having connection issues... 😔 Give me a minute?"}
+
+def rate_limit_error():
+    return {'success': False, 'error': 'rate_limit', 'message': random.choice(FLIRTY_RATE_LIMIT_ERRORS)}
+
+class Provider:
+    """One OpenAI-compatible endpoint + model, with its own health record.
+
+    The circuit opens after LLM_BREAKER_FAILURES consecutive failures and sheds
+    traffic for LLM_BREAKER_COOLDOWN seconds; after that a single probe request
+    is let through and its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, name, url, model, api_key, content_parts=True):
+        self.name = name
+        self.url = url
+        self.model = model
+        self.headers = {'Authorization': f'Bearer {api_key}'}
+        self.content_parts = content_parts  # Accepts list content with cache_control marks
+        self.latency = None     # EWMA seconds to first byte
+        self.failures = 0       # Consecutive failures
+        self.open_until = 0.0
+        self.probing = False
+
+    def available(self, now):
+        if self.failures < LLM_BREAKER_FAILURES:
+            return True
+        return now >= self.open_until and not self.probing
+
+    def begin(self):
+        if self.failures >= LLM_BREAKER_FAILURES:
+            self.probing = True
+
+    def observe_latency(self, seconds):
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += LATENCY_SMOOTHING * (seconds - self.latency)
+        metrics.LLM_PROVIDER_LATENCY.labels(self.name).set(self.latency)
+
+    def succeeded(self):
+        if self.failures >= LLM_BREAKER_FAILURES:
+            logger.info(f"LLM provider {self.name} recovered, closing circuit")
+            metrics.LLM_PROVIDER_OPEN.labels(self.name).set(0)
+        self.failures = 0
+
+    def failed(self, result):
+        """Count a failed request against the breaker; returns the result for convenience"""
+        self.failures += 1
+        if self.failures >= LLM_BREAKER_FAILURES:
+            self.open_until = time.monotonic() + LLM_BREAKER_COOLDOWN
+            metrics.LLM_PROVIDER_OPEN.labels(self.name).set(1)
+            logger.warning(f"LLM provider {self.name} failing ({result['error']}), circuit open for {LLM_BREAKER_COOLDOWN:.0f}s")
+        return result
+
+def _load_providers():
+    providers = [Provider('openrouter', OPENROUTER_URL, OPENROUTER_MODEL, OPENROUTER_API_KEY)]
+    for model in OPENROUTER_FALLBACK_MODELS:
+        providers.append(Provider(f'openrouter:{model}', OPENROUTER_URL, model, OPENROUTER_API_KEY))
+    if LLM_EXTRA_PROVIDERS:
+        for entry in json.loads(LLM_EXTRA_PROVIDERS):
+            providers.append(Provider(entry['name'], entry['url'], entry['model'], os.getenv(entry.get('api_key_env', ''), ''),
+                                      content_parts=entry.get('content_parts', False)))
+    return providers
+
+providers = _load_providers()
+
+def ranked_providers():
+    """Healthy providers, fastest first.
+
+    Providers with recent failures go after clean ones, and ones never
+    measured keep their configured order after the measured ones.
+    """
+    now = time.monotonic()
+    order = {id(p): i for i, p in enumerate(providers)}
+    healthy = [p for p in providers if p.available(now)]
+    return sorted(healthy, key=lambda p: (p.failures > 0, p.latency is None, p.latency or 0.0, order[id(p)]))
+
+def build_payload(messages, max_tokens, temperature, stream=False, stop=None):
+    # 'model' is filled in per provider
+    payload = {
+        'messages': messages,
+        'max_tokens': max_tokens,
+        'temperature': temperature,
+        'top_p': 0.9,
+        'frequency_penalty': 0.5,  # Higher to reduce repetition
+        'presence_penalty': 0.4    # Encourage variety
+    }
+    if stop:
+        payload['stop'] = stop
+    if stream:
+        payload['stream'] = True
+        payload['stream_options'] = {'include_usage': True}  # Token counts arrive in the final chunk
+    return payload
+
+async def _backoff(attempt, retries, deadline=None):
+    """Sleep before the next 429 retry; returns False when out of attempts or time"""
+    wait_time = (2 ** attempt) * 3  # Exponential backoff: 3s, 6s, 12s
+    logger.warning(f"Rate limited. Retrying in {wait_time}s... (attempt {attempt + 1}/{retries})")
+    if attempt >= retries - 1:
+        return False
+    if deadline is not None and time.monotonic() + wait_time >= deadline:
+        return False
+    metrics.LLM_RETRIES.inc()
+    await asyncio.sleep(wait_time)
+    return True
+
+def _error_message(body):
+    try:
+        return json.loads(body).get('error', {}).get('message', 'Unknown error')
+    except ValueError:
+        return 'Unknown error'
+
+def _count_tokens(usage):
+    if usage:
+        metrics.LLM_TOKENS.labels('in').inc(usage.get('prompt_tokens') or 0)
+        metrics.LLM_TOKENS.labels('out').inc(usage.get('completion_tokens') or 0)
+        # Prompt tokens served from the provider's prefix cache (part of 'in')
+        metrics.LLM_TOKENS.labels('cached').inc((usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0)
+
+def _status_error(provider, status, body):
+    if status == 429:
+        logger.warning(f"Rate limited by {provider.name}")
+        return provider.failed(rate_limit_error())
+    logger.error(f"API error from {provider.name}: {status} - {_error_message(body)}")
+    return provider.failed(API_ERROR)
+
+async def _attempt(provider, payload, on_delta=None, claim=None):
+    """_send() with its duration recorded per provider and outcome"""
+    started = time.monotonic()
+    outcome = 'cancelled'
+    try:
+        result = await _send(provider, payload, on_delta, claim)
+        outcome = 'success' if result['success'] else result['error']
+        return result
+    finally:
+        metrics.LLM_ATTEMPT.labels(provider.name, outcome).observe(time.monotonic() - started)
+
+async def _send(provider, payload, on_delta, claim):
+    """One request against one provider, recorded in its health stats.
+
+    When streaming, claim(provider) is called before the first chunk is shown;
+    only the attempt that wins the claim gets to call on_delta.
+    """
+    started = time.monotonic()
+    body = {**payload, 'model': provider.model}
+    if not provider.content_parts:
+        body['messages'] = prompts.flatten(body['messages'])
+    client = get_client()
+    try:
+        if on_delta is None:
+            resp = await client.post(provider.url, json=body, headers=provider.headers)
+            if resp.status_code != 200:
+                return _status_error(provider, resp.status_code, resp.text)
+            response_data = resp.json()
+            choice = response_data['choices'][0]
+            _count_tokens(response_data.get('usage'))
+            provider.observe_latency(time.monotonic() - started)
+            provider.succeeded()
+            return {'success': True, 'message': choice['message']['content'],
+                    'finish_reason': choice.get('finish_reason'), 'usage': response_data.get('usage')}
+
+        parts = []
+        deliver = on_delta
+        finish_reason = usage = None
+        async with client.stream('POST', provider.url, json=body, headers=provider.headers) as resp:
+            if resp.status_code != 200:
+                return _status_error(provider, resp.status_code, await resp.aread())
+            async for line in resp.aiter_lines():
+                # Skip blank separators and ": OPENROUTER PROCESSING" keep-alives
+                if not line.startswith('data: '):
+                    continue
+                data = line[6:]
+                if data == '[DONE]':
+                    break
+                chunk = json.loads(data)
+                if chunk.get('usage'):
+                    usage = chunk['usage']
+                    _count_tokens(usage)
+                if 'error' in chunk:
+                    logger.error(f"Stream error from {provider.name}: {chunk['error'].get('message', 'Unknown error')}")
+                    return provider.failed(API_ERROR)
+                choices = chunk.get('choices') or [{}]
+                finish_reason = choices[0].get('finish_reason') or finish_reason
+                delta = choices[0].get('delta', {}).get('content')
+                if delta:
+                    if not parts:
+                        if not claim(provider):
+                            return {'success': False, 'error': 'hedge_lost', 'message': ''}
+                        provider.observe_latency(time.monotonic() - started)
+                    parts.append(delta)
+                    if deliver:
+                        try:
+                            await deliver(''.join(parts))
+                        except Exception as e:
+                            # Showing partial text failed - that's not the provider's fault,
+                            # so finish the reply and let the caller deliver it whole
+                            logger.error(f"Error delivering streamed reply: {e}")
+                            deliver = None
+
+        if not parts:
+            return provider.failed(API_ERROR)
+        provider.succeeded()
+        return {'success': True, 'message': ''.join(parts), 'finish_reason': finish_reason, 'usage': usage}
+
+    except httpx.TimeoutException:
+        logger.error(f"Request timeout on {provider.name}")
+        return provider.failed(TIMEOUT_ERROR)
+
+    except Exception as e:
+        logger.error(f"Unexpected error from {provider.name}: {e}")
+        return provider.failed(UNKNOWN_ERROR)
+
+    finally:
+        provider.probing = False
+
+async def _route(payload, on_delta=None, deadline=None):
+    """One pass down the provider chain.
+
+    Starts on the best-ranked provider. A failure moves straight on to the next
+    one, and if no reply (first chunk, when streaming) arrives within
+    LLM_HEDGE_AFTER the next provider is raced against it. First success wins
+    and the losers are cancelled. If the deadline passes before anything has
+    been shown, everything is abandoned; a stream already underway finishes.
+    """
+    candidates = ranked_providers()
+    if not candidates:
+        logger.warning("Every LLM provider circuit is open")
+        return {**rate_limit_error(), 'error': 'unavailable'}
+
+    tasks = {}
+    failures = []
+    winner = None
+
+    def claim(provider):
+        nonlocal winner
+        if winner is None:
+            winner = provider
+            for other, task in tasks.items():
+                if other is not provider:
+                    task.cancel()
+        return winner is provider
+
+    def launch():
+        provider = candidates.pop(0)
+        provider.begin()
+        tasks[provider] = asyncio.create_task(_attempt(provider, payload, on_delta, claim))
+
+    launch()
+    try:
+        while tasks:
+            hedge = bool(candidates) and winner is None and LLM_HEDGE_AFTER > 0
+            timeout = LLM_HEDGE_AFTER if hedge else None
+            remaining = None if deadline is None or winner is not None else deadline - time.monotonic()
+            if remaining is not None:
+                if remaining <= 0:
+                    logger.warning("LLM request abandoned at its deadline")
+                    return DEADLINE_ERROR
+                timeout = remaining if timeout is None else min(timeout, remaining)
+            done, _ = await asyncio.wait(tasks.values(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done and remaining is not None and time.monotonic() >= deadline:
+                continue  # Out of time - handled at the top of the loop
+            if not done:
+                logger.info(f"No reply after {LLM_HEDGE_AFTER}s, hedging on {candidates[0].name}")
+                metrics.LLM_HEDGES.inc()
+                launch()
+                continue
+
+            for provider, task in list(tasks.items()):
+                if task not in done:
+                    continue
+                del tasks[provider]
+                if task.cancelled():
+                    continue
+                result = task.result()
+                if result['success']:
+                    return result
+                if winner is provider:
+                    # A stream that already showed text can't be handed to another provider or retried
+                    logger.warning(f"Stream from {provider.name} failed after showing text: {result['error']}")
+                    return INTERRUPTED_ERROR
+                failures.append(result)
+                if candidates and winner is None:
+                    launch()
+    finally:
+        for task in tasks.values():
+            task.cancel()
+
+    for error in ('rate_limit', 'timeout'):
+        for result in failures:
+            if result['error'] == error:
+                return result
+    return failures[0] if failures else API_ERROR
+
+async def _request(payload, on_delta, retries, deadline):
+    started = time.monotonic()
+    result = None
+    try:
+        result = await _retry_chain(payload, on_delta, retries, deadline)
+        return result
+    finally:
+        outcome = 'cancelled' if result is None else 'success' if result['success'] else result['error']
+        mode = 'stream' if on_delta else 'complete'
+        metrics.LLM_REQUEST.labels(mode, outcome).observe(time.monotonic() - started)
+
+async def _retry_chain(payload, on_delta, retries, deadline):
+    # Back off only once the whole chain is rate limited or timing out
+    for attempt in range(retries):
+        result = await _route(payload, on_delta, deadline)
+        if result['success'] or result['error'] not in ('rate_limit', 'timeout'):
+            return result
+        if not await _backoff(attempt, retries, deadline):
+            return result
+    return MAX_RETRIES_ERROR
+
+async def make_openrouter_request(messages, max_tokens, temperature=0.85, retries=3, deadline=None, stop=None):
+    """Get a chat completion from the fastest healthy provider, falling back down the chain.
+
+    deadline (time.monotonic()) bounds hedging, fallbacks and backoff; past it
+    the 'deadline' error comes back instead of another attempt. Cancelling the
+    awaiting task aborts the in-flight HTTP requests and any pending backoff
+    sleep, so callers can wrap this in asyncio.wait_for(). Successful results
+    also carry the provider's 'finish_reason' and 'usage'.
+    """
+    with metrics.span('llm'):
+        return await _request(build_payload(messages, max_tokens, temperature, stop=stop), None, retries, deadline)
+
+async def stream_openrouter_request(messages, max_tokens, on_delta, temperature=0.85, retries=3, deadline=None, stop=None):
+    """Streaming variant of make_openrouter_request.
+
+    Consumes the provider's SSE stream and awaits on_delta(text_so_far) for
+    every content chunk. Returns the same result dict, with the full reply in
+    'message'. Fallbacks, hedging, retries and the deadline only apply before
+    the first chunk has been delivered.
+    """
+    with metrics.span('llm'):
+        return await _request(build_payload(messages, max_tokens, temperature, stream=True, stop=stop), on_delta, retries, deadline)
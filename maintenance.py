@@ -0,0 +1,91 @@
+import logging
+import os
+import gzip
+import json
+import time
+import asyncio
+import datetime
+from telegram.ext import ContextTypes
+import storage
+import metrics
+
+# Housekeeping config
+PENDING_PAYMENT_TTL = int(os.getenv('PENDING_PAYMENT_TTL', str(48 * 3600)))  # Seconds before an unpaid /start_session expires
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '30'))
+ARCHIVE_KEEP = int(os.getenv('ARCHIVE_KEEP', '10'))  # Newest messages left in place so a returning user has context
+ARCHIVE_BATCH_USERS = int(os.getenv('ARCHIVE_BATCH_USERS', '500'))
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'archive')
+VACUUM_PAGES = int(os.getenv('VACUUM_PAGES', '2000'))  # Free pages returned to the OS per nightly run
+MEDIA_FILE_TTL = int(os.getenv('MEDIA_FILE_TTL', str(30 * 86400)))  # Seconds a sent image's file_id is kept for resends
+MAINTENANCE_HOUR = int(os.getenv('MAINTENANCE_HOUR', '4'))  # UTC
+
+logger = logging.getLogger(__name__)
+
+async def compact_history_job(context: ContextTypes.DEFAULT_TYPE):
+    removed = await storage.compact_history()
+    if removed:
+        logger.info(f"History compaction removed {removed} old messages")
+
+async def expire_payments_job(context: ContextTypes.DEFAULT_TYPE):
+    expired = await storage.expire_pending_payments(PENDING_PAYMENT_TTL)
+    if expired:
+        logger.info(f"Expired {expired} stale pending payments")
+
+def _write_archive(rows):
+    # One gzip member per run; gzip readers see the day's file as a single stream
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    path = os.path.join(ARCHIVE_DIR, f"messages-{datetime.datetime.now(datetime.timezone.utc):%Y-%m-%d}.jsonl.gz")
+    with gzip.open(path, 'at', encoding='utf-8') as f:
+        for user_id, seq, role, content, created_at in rows:
+            f.write(json.dumps({'user_id': user_id, 'seq': seq, 'role': role, 'content': content,
+                                'created_at': str(created_at)}) + '\n')
+    return path
+
+async def archive_inactive_users():
+    """Move inactive users' old messages out to gzipped JSONL, batch by batch.
+
+    Rows are written (and flushed) before they're deleted, so a crash can at
+    worst archive the same rows twice. Summaries stay in the database.
+    """
+    inactive_since = int(time.time()) - ARCHIVE_AFTER_DAYS * 86400
+    archived = 0
+    while True:
+        rows = await storage.get_archivable_messages(inactive_since, ARCHIVE_KEEP, ARCHIVE_BATCH_USERS)
+        if not rows:
+            break
+        path = await asyncio.to_thread(_write_archive, rows)
+        through = {}
+        for user_id, seq, *_ in rows:
+            through[user_id] = seq
+        archived += await storage.delete_messages_through(through)
+        logger.info(f"Archived history of {len(through)} inactive users to {path}")
+    return archived
+
+async def report_table_sizes():
+    stats = await storage.table_stats()
+    parts = []
+    for table, (rows, size) in stats.items():
+        metrics.DB_TABLE_ROWS.labels(table).set(rows)
+        if size is not None:
+            metrics.DB_TABLE_BYTES.labels(table).set(size)
+        parts.append(f"{table}={rows}" + (f" ({size / 1048576:.1f} MB)" if size is not None else ''))
+    logger.info(f"Table sizes: {', '.join(parts)}")
+
+async def nightly_job(context: ContextTypes.DEFAULT_TYPE):
+    """Archive, purge, reclaim space and refresh stats - heavy, so once a day off-peak"""
+    try:
+        archived = await archive_inactive_users()
+        purged = await storage.purge_abandoned_users(int(time.time()) - ARCHIVE_AFTER_DAYS * 86400)
+        media = await storage.expire_media_files(MEDIA_FILE_TTL)
+        started = time.monotonic()
+        await storage.optimize(VACUUM_PAGES)
+        logger.info(f"Housekeeping: archived {archived} messages, purged {purged} abandoned users, "
+                    f"expired {media} media file_ids, vacuum/optimize took {time.monotonic() - started:.1f}s")
+        await report_table_sizes()
+    except Exception as e:
+        logger.error(f"Error in nightly housekeeping: {e}")
+
+def schedule(job_queue):
+    job_queue.run_repeating(compact_history_job, interval=3600, first=60)
+    job_queue.run_repeating(expire_payments_job, interval=3600, first=120)
+    job_queue.run_daily(nightly_job, time=datetime.time(hour=MAINTENANCE_HOUR, tzinfo=datetime.timezone.utc))
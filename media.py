@@ -0,0 +1,103 @@
+import logging
+import os
+import time
+import hashlib
+import httpx
+from telegram.error import BadRequest, TimedOut
+import storage
+import metrics
+from cache import LRUCache
+
+# Media config - Telegram takes photo uploads up to 10 MB
+MEDIA_DOWNLOADS = int(os.getenv('MEDIA_DOWNLOADS', '4'))  # Concurrent image downloads
+MEDIA_DOWNLOAD_TIMEOUT = float(os.getenv('MEDIA_DOWNLOAD_TIMEOUT', '15'))
+MEDIA_MAX_BYTES = int(os.getenv('MEDIA_MAX_BYTES', str(10 * 1024 * 1024)))
+MEDIA_SEND_ATTEMPTS = 2
+
+logger = logging.getLogger(__name__)
+
+_client = None
+
+# media hash -> bytes of recent downloads, so a retried upload doesn't fetch again
+_recent = LRUCache(maxsize=32, ttl=600, name='media')
+
+def get_client():
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(MEDIA_DOWNLOAD_TIMEOUT, connect=5.0, pool=60.0),
+            limits=httpx.Limits(max_connections=MEDIA_DOWNLOADS, max_keepalive_connections=MEDIA_DOWNLOADS),
+            follow_redirects=True
+        )
+    return _client
+
+async def close_client():
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
+
+def media_hash(url):
+    return hashlib.sha256(url.encode()).hexdigest()
+
+async def download(url):
+    """Image bytes, or None if the host is too slow, errors or the file is too big to upload"""
+    started = time.monotonic()
+    outcome = 'failed'
+    try:
+        async with get_client().stream('GET', url) as resp:
+            if not resp.is_success:
+                logger.warning(f"Image download failed: {resp.status_code}")
+                return None
+            chunks = []
+            size = 0
+            async for chunk in resp.aiter_bytes():
+                size += len(chunk)
+                if size > MEDIA_MAX_BYTES:
+                    outcome = 'too_large'
+                    logger.warning(f"Image at {url} is over {MEDIA_MAX_BYTES} bytes, sending the URL instead")
+                    return None
+                chunks.append(chunk)
+            outcome = 'success'
+            return b''.join(chunks)
+    except httpx.HTTPError as e:
+        logger.warning(f"Image download failed: {e!r}")
+        return None
+    finally:
+        metrics.MEDIA_DOWNLOAD.labels(outcome).observe(time.monotonic() - started)
+
+async def send_photo(message, url, caption=None):
+    """Reply with the image at url, reusing Telegram's file_id if it was delivered before.
+
+    On first delivery the image is downloaded here and uploaded as bytes, so
+    Telegram never has to fetch from a slow host; the URL is only handed over
+    if the download fails. The file_id Telegram returns is stored by URL hash.
+    """
+    key = media_hash(url)
+    file_id = await storage.get_media_file_id(key)
+    if file_id:
+        try:
+            sent = await message.reply_photo(file_id, caption=caption)
+            metrics.MEDIA_SEND.labels('file_id').inc()
+            return sent
+        except BadRequest as e:
+            logger.warning(f"Stored file_id rejected, uploading again: {e}")
+
+    for attempt in range(MEDIA_SEND_ATTEMPTS):
+        data = _recent.get(key)
+        if data is None:
+            data = await download(url)
+            if data is not None:
+                _recent.set(key, data)
+        try:
+            sent = await message.reply_photo(data if data is not None else url, caption=caption)
+        except TimedOut:
+            if attempt + 1 == MEDIA_SEND_ATTEMPTS:
+                raise
+            logger.warning("Photo upload timed out, retrying")
+            continue
+        metrics.MEDIA_SEND.labels('upload' if data is not None else 'url').inc()
+        if sent.photo:
+            await storage.save_media_file_id(key, sent.photo[-1].file_id)
+        _recent.pop(key)
+        return sent
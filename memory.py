@@ -0,0 +1,95 @@
+import logging
+import os
+import asyncio
+import storage
+from llm import make_openrouter_request
+from scheduler import chat_scheduler, Overloaded
+
+# Context budget config - history tokens sent per request, by tier
+CONTEXT_BUDGETS = {'mild': 400, 'moderate': 700, 'explicit': 1000}
+CONTEXT_WINDOW_MAX = 24     # Most messages ever read for one turn
+SUMMARY_BATCH = int(os.getenv('SUMMARY_BATCH', '6'))  # Evicted messages needed before re-summarizing
+SUMMARY_MAX_TOKENS = 150
+MESSAGE_OVERHEAD = 4        # Role/formatting tokens per chat message
+
+logger = logging.getLogger(__name__)
+
+# Users with a summary job in flight, so turns don't pile up duplicate jobs
+_summarizing = set()
+
+def estimate_tokens(text):
+    """Rough token count - ~4 characters per token for English chat text"""
+    return len(text) // 4 + 1
+
+def message_tokens(content):
+    return estimate_tokens(content) + MESSAGE_OVERHEAD
+
+async def load_context(user_id):
+    return await storage.get_context(user_id, CONTEXT_WINDOW_MAX)
+
+def build_history(context, session_level, user_message):
+    """Fill the tier's token budget with the newest turns.
+
+    Returns (history messages, seq of the oldest message kept). Everything
+    before that seq is left to the rolling summary.
+    """
+    budget = CONTEXT_BUDGETS[session_level] - message_tokens(user_message)
+    if context.summary:
+        budget -= message_tokens(context.summary)
+
+    kept = []
+    oldest_seq = None
+    for seq, role, content in reversed(context.messages):
+        cost = message_tokens(content)
+        if cost > budget:
+            break
+        budget -= cost
+        kept.append({"role": role, "content": content})
+        oldest_seq = seq
+
+    kept.reverse()
+    if oldest_seq is None:
+        oldest_seq = context.messages[-1][0] + 1 if context.messages else 1
+    return kept, oldest_seq
+
+def summary_message(context):
+    if not context.summary:
+        return None
+    return {"role": "system", "content": f"What you remember from earlier in your conversation: {context.summary}"}
+
+def schedule_summary(user_id, context, oldest_kept_seq):
+    """Fold messages that fell out of the window into the summary, in the background"""
+    evicted_through = oldest_kept_seq - 1
+    if evicted_through - context.summary_through_seq < SUMMARY_BATCH or user_id in _summarizing:
+        return
+    _summarizing.add(user_id)
+    asyncio.create_task(_summarize(user_id, context.summary, context.summary_through_seq, evicted_through))
+
+async def _summarize(user_id, previous, after_seq, through_seq):
+    try:
+        rows = await storage.get_messages_between(user_id, after_seq, through_seq)
+        if not rows:
+            return
+        transcript = '\n'.join(f"{'Him' if role == 'user' else 'You'}: {content}" for _, role, content in rows)
+        prompt = (
+            "You keep short notes on an ongoing private chat between a girlfriend (You) and her boyfriend (Him). "
+            "Update the notes with the new messages. Keep facts about him, shared plans, running jokes, "
+            "preferences and the current mood. Max 5 short sentences, no preamble."
+        )
+        messages = [
+            {"role": "system", "content": prompt},
+            {"role": "user", "content": f"Current notes: {previous or '(none)'}\n\nNew messages:\n{transcript}"}
+        ]
+        # Lowest priority - under load the summary just waits for a later turn
+        async with chat_scheduler.llm_slot('background'):
+            result = await make_openrouter_request(messages, SUMMARY_MAX_TOKENS, temperature=0.3, retries=1)
+        if result['success']:
+            await storage.save_summary(user_id, result['message'].strip(), rows[-1][0])
+        else:
+            logger.warning(f"Summary for {user_id} skipped: {result['error']}")
+    except Overloaded:
+        logger.info(f"Summary for {user_id} skipped: LLM backlog full")
+    except Exception as e:
+        logger.error(f"Error summarizing history: {e}")
+    finally:
+        _summarizing.discard(user_id)
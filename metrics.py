@@ -0,0 +1,121 @@
+import logging
+import os
+import time
+import contextvars
+from contextlib import contextmanager
+from functools import wraps
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+    generate_latest, multiprocess, start_http_server
+)
+
+# Metrics config - webhook mode serves /metrics itself; polling and worker
+# processes need METRICS_PORT. With several uvicorn workers, set
+# PROMETHEUS_MULTIPROC_DIR so /metrics aggregates every process.
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+TRACE_UPDATES = os.getenv('TRACE_UPDATES', '0') != '0'
+TRACE_SLOW = float(os.getenv('TRACE_SLOW', '0'))  # Only log traces at least this many seconds long
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 20, 40, 80)
+DB_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 5)
+
+logger = logging.getLogger(__name__)
+
+# Hot path
+HANDLE_MESSAGE = Histogram('bot_handle_message_seconds', 'handle_message wall time', ['kind'], buckets=LATENCY_BUCKETS)
+CHAT_RESPONSE = Histogram('bot_chat_response_seconds', 'get_chat_response wall time', buckets=LATENCY_BUCKETS)
+SHED = Counter('bot_shed_total', 'Requests answered with a busy reply by admission control', ['path', 'tier'])
+CHAT_QUEUE_DEPTH = Gauge('bot_chat_queue_depth', 'Chat turns waiting to start', multiprocess_mode='livesum')
+CACHE_LOOKUPS = Counter('cache_lookups_total', 'In-process cache lookups', ['cache', 'result'])
+
+# LLM
+LLM_REQUEST = Histogram('llm_request_seconds', 'LLM request including fallbacks and backoff', ['mode', 'outcome'], buckets=LATENCY_BUCKETS)
+LLM_ATTEMPT = Histogram('llm_attempt_seconds', 'Single provider attempt', ['provider', 'outcome'], buckets=LATENCY_BUCKETS)
+LLM_IN_FLIGHT = Gauge('llm_in_flight', 'LLM calls holding a scheduler slot', multiprocess_mode='livesum')
+LLM_SLOT_WAITING = Gauge('llm_slot_waiting', 'LLM calls queued for a scheduler slot', ['tier'], multiprocess_mode='livesum')
+LLM_PROVIDER_LATENCY = Gauge('llm_provider_latency_seconds', 'Smoothed time to first byte used to rank providers', ['provider'],
+                             multiprocess_mode='mostrecent')
+LLM_PROVIDER_OPEN = Gauge('llm_provider_circuit_open', '1 while the provider circuit is open', ['provider'], multiprocess_mode='livemax')
+LLM_RETRIES = Counter('llm_retries_total', 'Backoff retries after the whole provider chain failed')
+LLM_HEDGES = Counter('llm_hedges_total', 'Hedged requests started on a second provider')
+LLM_TOKENS = Counter('llm_tokens_total', 'Tokens reported by the provider; cached is the part of in served from prompt cache', ['direction'])
+LLM_BUDGET_USED = Histogram('llm_budget_used_ratio', 'Completion tokens over the max_tokens budget of a chat reply', ['tier'],
+                            buckets=(.1, .2, .3, .4, .5, .6, .7, .8, .9, 1))
+LLM_TRUNCATED = Counter('llm_truncated_total', 'Chat replies cut off by max_tokens and trimmed to a whole sentence', ['tier'])
+
+# Telegram sends
+TELEGRAM_SEND_WAIT = Histogram('telegram_send_wait_seconds', 'Time a Bot API call waited in the send limiter', ['priority'], buckets=LATENCY_BUCKETS)
+TELEGRAM_FLOOD_WAITS = Counter('telegram_flood_waits_total', 'RetryAfter responses from the Bot API', ['method'])
+TELEGRAM_DROPPED = Counter('telegram_dropped_total', 'Best-effort calls skipped while sends were backed up', ['method'])
+
+# Images and payments
+IMAGE_GENERATION = Histogram('image_generation_seconds', 'generate_image wall time', ['outcome'], buckets=LATENCY_BUCKETS)
+IMAGE_QUEUE_DEPTH = Gauge('image_queue_depth', 'Image jobs waiting for a worker', multiprocess_mode='livesum')
+MEDIA_DOWNLOAD = Histogram('media_download_seconds', 'Generated image downloads before upload', ['outcome'], buckets=LATENCY_BUCKETS)
+MEDIA_SEND = Counter('media_send_total', 'Photos sent, by how Telegram got the file', ['source'])
+PAYMENT_CHECK = Histogram('payment_check_seconds', 'check_usdt_transfer wall time', ['outcome'], buckets=LATENCY_BUCKETS)
+
+# Storage
+DB_CALL = Histogram('db_call_seconds', 'Storage call wall time, queueing included', ['kind', 'op'], buckets=DB_BUCKETS)
+DB_WAIT = Histogram('db_lock_wait_seconds', 'Time waiting for a reader thread or the single writer', ['kind'], buckets=DB_BUCKETS)
+DB_TABLE_ROWS = Gauge('db_table_rows', 'Rows per table, from the last housekeeping report', ['table'], multiprocess_mode='mostrecent')
+DB_TABLE_BYTES = Gauge('db_table_bytes', 'Table plus index size, from the last housekeeping report', ['table'], multiprocess_mode='mostrecent')
+
+def render():
+    """(body, content type) for a Prometheus scrape of this process, or of all workers in multiprocess mode"""
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+def serve_standalone():
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT)
+        logger.info(f"Metrics on :{METRICS_PORT}/metrics")
+
+# Per-update tracing - spans recorded anywhere under trace() are logged as one line
+_spans = contextvars.ContextVar('spans', default=None)
+
+@contextmanager
+def trace(name, **attrs):
+    if not TRACE_UPDATES:
+        yield
+        return
+    spans = []
+    token = _spans.set(spans)
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        _spans.reset(token)
+        total = time.monotonic() - started
+        if total >= TRACE_SLOW:
+            fields = ' '.join(f'{key}={value}' for key, value in attrs.items())
+            timings = ' '.join(f'{span}={seconds * 1000:.0f}ms' for span, seconds in spans)
+            logger.info(f"trace {name} {fields} total={total * 1000:.0f}ms {timings}")
+
+@contextmanager
+def span(name):
+    spans = _spans.get()
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        if spans is not None:
+            spans.append((name, time.monotonic() - started))
+
+def timed(histogram, name):
+    """Decorator: observe an async function's duration and record it as a trace span"""
+    def decorator(fn):
+        @wraps(fn)
+        async def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                with span(name):
+                    return await fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.monotonic() - started)
+        return wrapper
+    return decorator
@@ -0,0 +1,198 @@
+import logging
+import os
+import time
+import heapq
+import asyncio
+import itertools
+import contextvars
+from contextlib import contextmanager
+from datetime import timedelta
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+from scheduler import TokenBucket
+from cache import LRUCache
+import profiles
+import metrics
+
+# Send limits - Telegram allows about 30 messages/s per bot, 1/s per private
+# chat (short bursts are tolerated) and 20/min per group. With several bot
+# processes, split SEND_RATE_GLOBAL between them.
+SEND_RATE_GLOBAL = float(os.getenv('SEND_RATE_GLOBAL', '30'))
+SEND_RATE_CHAT = float(os.getenv('SEND_RATE_CHAT', '1'))
+SEND_BURST_CHAT = int(os.getenv('SEND_BURST_CHAT', '3'))
+SEND_RATE_GROUP = float(os.getenv('SEND_RATE_GROUP', '20')) / 60
+SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', '3'))  # RetryAfter retries before a send fails
+SEND_TRACKED_CHATS = 10000
+
+# Bot API connection pool - sends are paced by the limiter, so a modest pool
+# stays warm, and a longer pool timeout covers bursts instead of failing them
+TELEGRAM_POOL_SIZE = int(os.getenv('TELEGRAM_POOL_SIZE', '64'))
+TELEGRAM_POOL_TIMEOUT = float(os.getenv('TELEGRAM_POOL_TIMEOUT', '10'))
+
+# Lower goes first; best-effort calls sit behind every reply
+PAID, NORMAL, BEST_EFFORT = 0, 1, 2
+PRIORITY_NAMES = {PAID: 'paid', NORMAL: 'normal', BEST_EFFORT: 'best_effort'}
+
+logger = logging.getLogger(__name__)
+
+_best_effort = contextvars.ContextVar('best_effort', default=False)
+
+@contextmanager
+def best_effort():
+    """Sends inside this block wait behind replies and give up on RetryAfter instead of retrying"""
+    token = _best_effort.set(True)
+    try:
+        yield
+    finally:
+        _best_effort.reset(token)
+
+def retry_after_seconds(error):
+    # RetryAfter.retry_after is an int today and a timedelta in newer releases
+    delay = error.retry_after
+    return delay.total_seconds() if isinstance(delay, timedelta) else delay
+
+class PriorityBucket:
+    """Token bucket whose waiters are served lowest priority number first, FIFO within a priority"""
+
+    def __init__(self, rate_per_second, capacity):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._heap = []
+        self._order = itertools.count()
+        self._pump = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self):
+        self._refill()
+        if self._tokens >= 1 and not self._heap:
+            self._tokens -= 1
+            return True
+        return False
+
+    async def acquire(self, priority):
+        if self.try_acquire():
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, next(self._order), future))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._hand_out())
+        await future
+
+    async def _hand_out(self):
+        # One task refills and hands tokens to waiters; cancelled waiters are skipped
+        while self._heap:
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                continue
+            _, _, future = heapq.heappop(self._heap)
+            if not future.done():
+                self._tokens -= 1
+                future.set_result(None)
+
+    def close(self):
+        if self._pump is not None:
+            self._pump.cancel()
+
+class _Chat:
+    __slots__ = ('bucket', 'paused_until')
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.paused_until = 0.0
+
+class SendLimiter(BaseRateLimiter):
+    """Every Bot API call goes through here (except getUpdates).
+
+    Each chat has its own FIFO token bucket, so a chat's messages keep their
+    order, and then all calls share one global bucket that serves paid
+    sessions first. A RetryAfter pauses that chat (or everything, for calls
+    without a chat) and the call is retried up to SEND_MAX_RETRIES times.
+    Chat actions are dropped rather than queued when sends are backed up.
+    """
+
+    def __init__(self, global_rate=SEND_RATE_GLOBAL, chat_rate=SEND_RATE_CHAT, chat_burst=SEND_BURST_CHAT,
+                 max_retries=SEND_MAX_RETRIES):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = PriorityBucket(global_rate, max(int(global_rate), 1))
+        self._chats = LRUCache(maxsize=SEND_TRACKED_CHATS)
+        self._paused_until = 0.0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        self._global.close()
+
+    def _chat(self, chat_id):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            if chat_id < 0:
+                chat = _Chat(TokenBucket(SEND_RATE_GROUP, 1))
+            else:
+                chat = _Chat(TokenBucket(self.chat_rate, self.chat_burst))
+            self._chats.set(chat_id, chat)
+        return chat
+
+    def _priority(self, chat_id):
+        if _best_effort.get():
+            return BEST_EFFORT
+        # Private chat ids are user ids; only already-cached profiles are consulted
+        user = profiles.profile_cache.peek(chat_id) if chat_id is not None else None
+        return PAID if user and user.current_session in ('moderate', 'explicit') else NORMAL
+
+    async def _wait_paused(self, chat):
+        while True:
+            until = max(self._paused_until, chat.paused_until if chat else 0.0)
+            delay = until - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        try:
+            chat_id = int(data.get('chat_id'))
+        except (TypeError, ValueError):
+            chat_id = None  # No chat, or an @channel username
+
+        if endpoint == 'sendChatAction':
+            now = time.monotonic()
+            chat = self._chats.peek(chat_id) if chat_id is not None else None
+            if now < self._paused_until or (chat and now < chat.paused_until) or not self._global.try_acquire():
+                metrics.TELEGRAM_DROPPED.labels(endpoint).inc()
+                return True
+            return await callback(*args, **kwargs)
+
+        chat = self._chat(chat_id) if chat_id is not None else None
+        priority = self._priority(chat_id)
+        max_retries = 0 if priority == BEST_EFFORT else self.max_retries
+        if rate_limit_args is not None:
+            max_retries = rate_limit_args
+
+        for attempt in range(max_retries + 1):
+            started = time.monotonic()
+            await self._wait_paused(chat)
+            if chat:
+                await chat.bucket.acquire()
+            await self._global.acquire(priority)
+            metrics.TELEGRAM_SEND_WAIT.labels(PRIORITY_NAMES[priority]).observe(time.monotonic() - started)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                metrics.TELEGRAM_FLOOD_WAITS.labels(endpoint).inc()
+                until = time.monotonic() + retry_after_seconds(e)
+                if chat:
+                    chat.paused_until = max(chat.paused_until, until)
+                else:
+                    self._paused_until = max(self._paused_until, until)
+                if attempt == max_retries:
+                    raise
+                logger.warning(f"{endpoint} to {chat_id} hit flood control, retrying in {retry_after_seconds(e)}s")
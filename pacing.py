@@ -0,0 +1,44 @@
+import logging
+import os
+import time
+import random
+import asyncio
+from contextlib import asynccontextmanager
+from telegram.constants import ChatAction
+from telegram.error import TelegramError
+
+# Humanized pacing - replies never land faster than a person could plausibly type
+PACING_MIN = float(os.getenv('PACING_MIN', '0.5'))
+PACING_MAX = float(os.getenv('PACING_MAX', '1.5'))
+PACING_PER_CHAR = float(os.getenv('PACING_PER_CHAR', '0.005'))  # +1s per 200 chars, up to PACING_MAX
+TYPING_REFRESH = 4.0  # Telegram clears the typing status after ~5s
+
+logger = logging.getLogger(__name__)
+
+def min_response_time(reply_length):
+    """Floor on total response time for a reply of this many characters"""
+    floor = min(PACING_MAX, PACING_MIN + reply_length * PACING_PER_CHAR)
+    return floor * random.uniform(0.85, 1.15)
+
+async def pace(started, reply_length):
+    """Sleep only for whatever is left of the floor since `started` (time.monotonic())"""
+    remaining = min_response_time(reply_length) - (time.monotonic() - started)
+    if remaining > 0:
+        await asyncio.sleep(remaining)
+
+@asynccontextmanager
+async def keep_typing(chat, action=ChatAction.TYPING):
+    """Show the typing indicator and keep refreshing it until the block exits"""
+    async def _refresh():
+        while True:
+            try:
+                await chat.send_action(action)
+            except TelegramError as e:
+                logger.warning(f"Could not send chat action: {e}")
+            await asyncio.sleep(TYPING_REFRESH)
+
+    task = asyncio.create_task(_refresh())
+    try:
+        yield
+    finally:
+        task.cancel()
@@ -0,0 +1,144 @@
+import logging
+import os
+import time
+import base64
+import binascii
+import httpx
+import storage
+import metrics
+
+# Keys/config
+MY_WALLET_ADDRESS = os.getenv('MY_WALLET_ADDRESS')
+TONCENTER_API_KEY = os.getenv('TONCENTER_API_KEY')
+
+# TON Center config
+TON_CENTER_URL = os.getenv('TON_CENTER_URL', 'https://toncenter.com/api/v3/jetton/transfers')
+USDT_JETTON_MASTER = 'EQCxE6mUtQJKFnGfaROTKOt1lZbDiiX1kCixRv7Nw2Id_sDs'
+POLL_PAGE_SIZE = 100
+POLL_INTERVAL = float(os.getenv('PAYMENT_POLL_INTERVAL', '15'))
+POLL_BACKFILL = 3600  # Seconds of history fetched on the very first poll
+CURSOR_KEY = 'usdt_transfers_last_lt'
+
+AMOUNTS = {'mild': 2, 'moderate': 8, 'explicit': 15}
+# USDT has 6 decimals; TON Center reports amounts as integer strings
+EXPECTED_NANO = {level: str(int(usd * 10**6)) for level, usd in AMOUNTS.items()}
+
+logger = logging.getLogger(__name__)
+
+_client = None
+
+def get_client():
+    global _client
+    if _client is None or _client.is_closed:
+        headers = {'X-API-Key': TONCENTER_API_KEY} if TONCENTER_API_KEY else {}
+        _client = httpx.AsyncClient(timeout=10, headers=headers)
+    return _client
+
+async def close_client():
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
+
+def _crc16(data):
+    # CRC-16/XMODEM, the checksum at the end of user-friendly TON addresses
+    crc = 0
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            crc = (crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1
+    return (crc & 0xFFFF).to_bytes(2, 'big')
+
+def normalize_address(address):
+    """Raw 'workchain:HEX' form of a TON address, or None if it isn't one.
+
+    TON Center reports transfer sources in raw form while wallets show the
+    user-friendly EQ.../UQ... form, so both sides are stored like this.
+    """
+    address = address.strip()
+    if ':' in address:
+        workchain, _, account = address.partition(':')
+        try:
+            if len(bytes.fromhex(account)) == 32:
+                return f'{int(workchain)}:{account.upper()}'
+        except ValueError:
+            pass
+        return None
+    try:
+        data = base64.urlsafe_b64decode(address.replace('+', '-').replace('/', '_'))
+    except (ValueError, binascii.Error):
+        return None
+    if len(data) != 36 or _crc16(data[:34]) != data[34:]:
+        return None
+    workchain = int.from_bytes(data[1:2], 'big', signed=True)
+    return f'{workchain}:{data[2:34].hex().upper()}'
+
+def _source_address(transfer):
+    # v3 returns the sender as a raw string; older responses nest it
+    source = transfer.get('source') or ''
+    source = source.get('address', '') if isinstance(source, dict) else source
+    return normalize_address(source) or source
+
+async def poll_transfers():
+    """Page through incoming USDT transfers since the stored cursor and index them.
+
+    Returns the number of transfers fetched.
+    """
+    client = get_client()
+    last_lt = await storage.get_sync_value(CURSOR_KEY)
+    params = {
+        'owner_address': MY_WALLET_ADDRESS,
+        'direction': 'in',
+        'jetton_master': USDT_JETTON_MASTER,
+        'limit': POLL_PAGE_SIZE,
+        'sort': 'asc'
+    }
+    if last_lt:
+        params['start_lt'] = int(last_lt)  # Inclusive; the boundary transfer is deduplicated on insert
+    else:
+        params['start_utime'] = int(time.time()) - POLL_BACKFILL
+
+    fetched = 0
+    offset = 0
+    while True:
+        resp = await client.get(TON_CENTER_URL, params={**params, 'offset': offset})
+        resp.raise_for_status()
+        transfers = resp.json().get('jetton_transfers', [])
+        if not transfers:
+            break
+
+        rows = [
+            (t['transaction_hash'], int(t['transaction_lt']), _source_address(t), t.get('amount', ''), int(t.get('transaction_now', 0)))
+            for t in transfers
+        ]
+        last_lt = str(max(row[1] for row in rows))
+        await storage.save_transfers(rows, CURSOR_KEY, last_lt)
+
+        fetched += len(transfers)
+        if len(transfers) < POLL_PAGE_SIZE:
+            break
+        offset += POLL_PAGE_SIZE
+    return fetched
+
+async def check_usdt_transfer(user_id, ton_address):
+    """Match the user's pending payment against the local transfer index.
+
+    Returns the girlfriend's name if a transfer was claimed and the session
+    activated, otherwise None. ton_address must already be normalized. The
+    background poller keeps the index fresh, so this never calls TON Center
+    itself.
+    """
+    started = time.monotonic()
+    gf_name = await storage.confirm_pending_payment(user_id, ton_address, EXPECTED_NANO)
+    metrics.PAYMENT_CHECK.labels('matched' if gf_name else 'not_found').observe(time.monotonic() - started)
+    return gf_name
+
+async def poll_and_match():
+    """One poller tick - index new transfers, then activate any pending payments they settle"""
+    try:
+        fetched = await poll_transfers()
+        if fetched:
+            logger.info(f"Indexed {fetched} incoming USDT transfers")
+    except (httpx.HTTPError, ValueError, KeyError) as e:
+        logger.error(f"Error polling USDT transfers: {e}")
+    return await storage.match_pending_payments(EXPECTED_NANO)
@@ -0,0 +1,74 @@
+import json
+from telegram.ext import BasePersistence, PersistenceInput
+import storage
+
+class StoragePersistence(BasePersistence):
+    """python-telegram-bot persistence on top of the shared storage backend.
+
+    Keeps ConversationHandler states and user_data (the /find_gf answers) in
+    the bot_state table, so onboarding survives restarts and a user's
+    conversation can be picked up by whichever worker owns their shard.
+    Chat/bot/callback data aren't used by this bot and aren't stored.
+
+    State is only read back at startup - PTB loads conversations once and
+    nothing here refreshes from other processes. That's enough because
+    sharded mode (UPDATE_SHARDS) is the only supported multi-process setup:
+    each user's updates are handled by one process at a time, and
+    webhook.serve() refuses to run several unsharded workers.
+    """
+
+    def __init__(self, update_interval=5):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+
+    async def get_user_data(self):
+        return {int(user_id): data for user_id, data in (await storage.load_bot_state('user_data')).items()}
+
+    async def update_user_data(self, user_id, data):
+        await storage.save_bot_state('user_data', str(user_id), data or None)
+
+    async def drop_user_data(self, user_id):
+        await storage.save_bot_state('user_data', str(user_id), None)
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def get_conversations(self, name):
+        states = await storage.load_bot_state(f'conversation:{name}')
+        return {tuple(json.loads(key)): state for key, state in states.items()}
+
+    async def update_conversation(self, name, key, new_state):
+        await storage.save_bot_state(f'conversation:{name}', json.dumps(list(key)), new_state)
+
+    # Unused stores
+    async def get_chat_data(self):
+        return {}
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def get_bot_data(self):
+        return {}
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def flush(self):
+        pass
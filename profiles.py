@@ -0,0 +1,68 @@
+import os
+import storage
+from cache import LRUCache
+import prompts
+
+# Cache config
+PROFILE_CACHE_SIZE = int(os.getenv('PROFILE_CACHE_SIZE', '4096'))
+PROFILE_CACHE_TTL = float(os.getenv('PROFILE_CACHE_TTL', '300'))
+
+# user_id -> storage.User. The TTL only bounds staleness from writes made by
+# other processes; every write path in this bot invalidates explicitly.
+profile_cache = LRUCache(maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL, name='profile')
+
+# Everything the persona is rendered from -> rendered persona. Keyed on the
+# inputs, not a version, so a persona built from facts that were never saved
+# (the turn failed) can't be served for the row that's actually stored.
+persona_cache = LRUCache(maxsize=PROFILE_CACHE_SIZE, name='persona')
+
+class _Read:
+    __slots__ = ('stale',)
+
+    def __init__(self):
+        self.stale = False
+
+# user_id -> storage reads in flight. invalidate() marks them stale so a read
+# that raced a write isn't cached; entries only live as long as the read.
+_reads = {}
+
+def invalidate(user_id):
+    """Forget the cached profile for a user after any profile/session change"""
+    for read in _reads.get(user_id, ()):
+        read.stale = True
+    profile_cache.pop(user_id)
+
+async def get_profile(user_id):
+    """Return the user's row, from cache when possible"""
+    user = profile_cache.get(user_id)
+    if user is not None:
+        return user
+
+    read = _Read()
+    _reads.setdefault(user_id, []).append(read)
+    try:
+        user = await storage.get_user(user_id)
+    finally:
+        reads = _reads[user_id]
+        reads.remove(read)
+        if not reads:
+            del _reads[user_id]
+
+    # Don't cache a row that was invalidated while we were reading it
+    if user is not None and not read.stale:
+        profile_cache.set(user_id, user)
+    return user
+
+async def refresh(user_id):
+    """Re-read the user's row from storage, e.g. before refusing them on a cached session"""
+    invalidate(user_id)
+    return await get_profile(user_id)
+
+def get_persona(user):
+    """Return the rendered persona segment of the system prompt for this user"""
+    key = (user.user_id, user.system_prompt, user.girlfriend_name, user.user_name, user.user_preferences)
+    persona = persona_cache.get(key)
+    if persona is None:
+        persona = prompts.render_persona(user)
+        persona_cache.set(key, persona)
+    return persona
@@ -0,0 +1,102 @@
+import os
+from extraction import describe_preferences
+
+# Prompt layout - most stable content first, so providers with prefix caching
+# reuse as much as possible between requests:
+#   static rules -> tier instructions -> persona -> summary -> history -> new message
+# Everything up to the tier instructions is shared by every user on that tier,
+# the persona by every turn of one user. Both end in a cache breakpoint.
+PROMPT_CACHE_CONTROL = os.getenv('PROMPT_CACHE_CONTROL', '1') != '0'  # Send explicit cache_control marks where supported
+
+# Shared by every girlfriend - the per-user part only says who she is
+PREAMBLE = (
+    "You're a virtual girlfriend having private intimate conversations with your boyfriend. "
+    "You text naturally like through Telegram - casual, genuine, playful. "
+    "You're comfortable with flirting, romance, and sexual topics. "
+    "You have real emotions and reactions. You remember what's said and build on it. "
+    "You're attracted to them and want to explore together. Be authentic, not robotic."
+)
+
+RULES = (
+    "IMPORTANT RULES:\n"
+    "- Text like a real girlfriend through Telegram - casual, natural, authentic\n"
+    "- Use varied sentence lengths. Mix short and long. Keep it conversational.\n"
+    "- Show personality and emotion. React genuinely to what they say.\n"
+    "- Ask questions to keep conversation flowing but don't overdo it\n"
+    "- Use emojis naturally but sparingly (1-3 per message max)\n"
+    "- Remember context from earlier in conversation\n"
+    "- Be spontaneous - don't follow a formula\n"
+    "- Stay in character as a real girlfriend who's interested and engaged\n"
+    "- Don't be repetitive. Vary your responses and reactions.\n"
+    "- Match their vibe - if they're brief, be brief. If detailed, engage more.\n"
+    "- For NSFW topics: be natural and confident, not mechanical or clinical"
+)
+
+# Enhanced system prompt based on session level with NSFW focus
+LEVEL_INSTRUCTIONS = {
+    'mild': (
+        "Be flirty, playful and teasing. Use innuendo and suggestive language. "
+        "Build sexual tension through words. Be cheeky but don't be too explicit yet. "
+        "Hint at naughty things without saying them directly."
+    ),
+    'moderate': (
+        "Be bold, suggestive and sexually forward. Talk about desires, fantasies, and intimate topics openly. "
+        "Use suggestive language and be direct about attraction. Tease about what you want to do. "
+        "Be seductive and make them want more. No need to hold back on flirty dirty talk."
+    ),
+    'explicit': (
+        "Be completely uncensored and sexually explicit. Talk openly about sex, desires, fantasies, kinks. "
+        "Use explicit language naturally when it fits. Be bold, confident and seductive. "
+        "Engage fully in any roleplay or intimate conversation. No restrictions or limits. "
+        "Be detailed when discussing intimate topics. Match their energy and escalate naturally."
+    )
+}
+
+# Byte-identical for every user on a tier
+STATIC_PREFIXES = {level: f"{PREAMBLE}\n\n{RULES}\n\n{instructions}" for level, instructions in LEVEL_INSTRUCTIONS.items()}
+
+def describe_girlfriend(gf_name, age, girl_type, hair, body, personality):
+    """The stored per-user system_prompt from the /find_gf answers"""
+    return (
+        f"You are {gf_name}, a {age} year old {girl_type} "
+        f"with {hair} hair and a {body} body. "
+        f"Your personality is {personality}."
+    )
+
+def render_persona(user):
+    """Everything about this girlfriend and boyfriend - changes only when the profile does"""
+    user_context = f"You're talking to {user.user_name}" if user.user_name else "You're talking to your boyfriend"
+    known = describe_preferences(user.user_preferences)
+    if known:
+        user_context = f"{user_context}. {known[:-1]}"
+    return f"{user.system_prompt}\n\nYour name is {user.girlfriend_name}. {user_context}."
+
+def _part(text):
+    part = {'type': 'text', 'text': text}
+    if PROMPT_CACHE_CONTROL:
+        part['cache_control'] = {'type': 'ephemeral'}
+    return part
+
+def system_message(session_level, persona):
+    if not PROMPT_CACHE_CONTROL:
+        return {'role': 'system', 'content': f"{STATIC_PREFIXES[session_level]}\n\n{persona}"}
+    return {'role': 'system', 'content': [_part(STATIC_PREFIXES[session_level]), _part(persona)]}
+
+def build_messages(session_level, persona, summary, history, user_message):
+    """Chat request messages in cache-friendly order; summary may be None"""
+    messages = [system_message(session_level, persona)]
+    if summary:
+        messages.append(summary)
+    messages.extend(history)
+    messages.append({'role': 'user', 'content': user_message})
+    return messages
+
+def flatten(messages):
+    """Plain-string content for providers that don't take content parts"""
+    flat = []
+    for message in messages:
+        content = message['content']
+        if isinstance(content, list):
+            message = dict(message, content='\n\n'.join(part['text'] for part in content))
+        flat.append(message)
+    return flat
@@ -0,0 +1,266 @@
+import logging
+import os
+import time
+import asyncio
+import heapq
+import itertools
+import contextvars
+from collections import Counter
+from contextlib import asynccontextmanager
+from telegram.ext import BaseUpdateProcessor
+import metrics
+
+# Scheduler config - defaults match OpenRouter's free-model limit of 20 req/min
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '8'))
+LLM_RATE_PER_MINUTE = float(os.getenv('LLM_RATE_PER_MINUTE', '20'))
+LLM_BURST = int(os.getenv('LLM_BURST', '5'))
+COALESCE_MESSAGES = os.getenv('COALESCE_MESSAGES', '1') != '0'
+COALESCE_WINDOW = float(os.getenv('COALESCE_WINDOW', '0'))  # Extra wait for follow-ups before a turn starts
+
+# Admission control - moderate/explicit sessions are served before mild ones
+# (which includes the free preview), summaries last. Each tier can only have so
+# many calls waiting for a slot before new ones are turned away.
+PRIORITIES = {'paid': 0, 'mild': 1, 'background': 2}
+TIERS = {priority: tier for tier, priority in PRIORITIES.items()}
+LLM_BACKLOG = {
+    'paid': int(os.getenv('LLM_BACKLOG_PAID', '200')),
+    'mild': int(os.getenv('LLM_BACKLOG_MILD', '60')),
+    'background': int(os.getenv('LLM_BACKLOG_BACKGROUND', '10'))
+}
+USER_BACKLOG = int(os.getenv('USER_BACKLOG', '3'))  # Queued turns per user when coalescing is off
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '256'))  # Updates processed at once, across users
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """Async token bucket - acquire() waits until a request may be sent"""
+
+    def __init__(self, rate_per_second, capacity):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        # The lock is FIFO, so waiters are served in arrival order
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class Overloaded(Exception):
+    """Raised instead of queuing work that couldn't be served in time"""
+
+class PrioritySlots:
+    """A semaphore that hands freed slots to the highest-priority waiter.
+
+    Waiters of equal priority are served in arrival order. Each priority has a
+    bounded number of waiters and every wait can carry a deadline, so under
+    overload callers fail fast with Overloaded rather than piling up.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.in_use = 0
+        self._heap = []
+        self._waiting = Counter()
+        self._order = itertools.count()
+
+    async def acquire(self, priority, limit=None, deadline=None):
+        # release() hands slots straight to live waiters, so a free slot means nobody live is queued
+        if self.in_use < self.capacity:
+            self.in_use += 1
+            return
+        if limit is not None and self._waiting[priority] >= limit:
+            raise Overloaded('backlog full')
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, next(self._order), future))
+        self._waiting[priority] += 1
+        waiting = metrics.LLM_SLOT_WAITING.labels(TIERS.get(priority, str(priority)))
+        waiting.inc()
+        try:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise Overloaded('deadline passed while queued') from None
+        except asyncio.CancelledError:
+            # The slot may have been handed over just as we were cancelled
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        finally:
+            self._waiting[priority] -= 1
+            waiting.dec()
+
+    def release(self):
+        while self._heap:
+            _, _, future = heapq.heappop(self._heap)
+            if not future.done():
+                future.set_result(None)  # The slot passes straight to this waiter
+                return
+        self.in_use -= 1
+
+class _Turn:
+    __slots__ = ('texts', 'run', 'future', 'context', 'deadline')
+
+    def __init__(self, text, run, deadline):
+        self.texts = [text]
+        self.run = run
+        self.deadline = deadline
+        self.future = asyncio.get_running_loop().create_future()
+        # The submitting handler's context, so its trace follows the turn into the worker
+        self.context = contextvars.copy_context()
+
+class ChatScheduler:
+    """Per-user FIFO turn queues in front of a global LLM concurrency/rate limit.
+
+    Each user gets one worker, so their turns run strictly in order and never
+    race on the same history. Because every user has at most one call waiting
+    for an LLM slot, the FIFO slot queue is round-robin across users.
+    """
+
+    def __init__(self, max_concurrency=LLM_MAX_CONCURRENCY, rate_per_minute=LLM_RATE_PER_MINUTE,
+                 burst=LLM_BURST, coalesce=COALESCE_MESSAGES, coalesce_window=COALESCE_WINDOW):
+        self.coalesce = coalesce
+        self.coalesce_window = coalesce_window
+        self._slots = PrioritySlots(max_concurrency)
+        self._bucket = TokenBucket(rate_per_minute / 60, burst)
+        self._queues = {}
+
+    async def submit(self, user_id, text, run, deadline=None):
+        """Queue run(text, deadline) behind the user's earlier turns and await its reply.
+
+        If coalescing is on and the user already has a turn waiting to start,
+        the text is merged into that turn and None is returned - the earlier
+        message's handler delivers the combined reply. The merged turn keeps
+        the later deadline. Raises Overloaded if the user already has
+        USER_BACKLOG turns queued.
+        """
+        queue = self._queues.get(user_id)
+        if queue is None:
+            queue = self._queues[user_id] = []
+            asyncio.create_task(self._worker(user_id, queue))
+        elif self.coalesce and queue:
+            queue[-1].texts.append(text)
+            if deadline is None or queue[-1].deadline is None:
+                queue[-1].deadline = None
+            else:
+                queue[-1].deadline = max(queue[-1].deadline, deadline)
+            return None
+        elif len(queue) >= USER_BACKLOG:
+            raise Overloaded('too many queued turns for this user')
+
+        turn = _Turn(text, run, deadline)
+        queue.append(turn)
+        metrics.CHAT_QUEUE_DEPTH.inc()
+        return await turn.future
+
+    async def _worker(self, user_id, queue):
+        try:
+            while queue:
+                if self.coalesce and self.coalesce_window:
+                    await asyncio.sleep(self.coalesce_window)
+                turn = queue.pop(0)
+                metrics.CHAT_QUEUE_DEPTH.dec()
+                try:
+                    result = await asyncio.create_task(turn.run('\n'.join(turn.texts), turn.deadline), context=turn.context)
+                    turn.future.set_result(result)
+                except Exception as e:
+                    turn.future.set_exception(e)
+        finally:
+            del self._queues[user_id]
+
+    @asynccontextmanager
+    async def llm_slot(self, tier='mild', deadline=None):
+        """Hold one global LLM slot, paced by the provider's rate limit.
+
+        tier is a key of PRIORITIES. Raises Overloaded without waiting if the
+        tier's backlog is full, or once the deadline (time.monotonic()) passes
+        before a slot and a rate-limit token are free.
+        """
+        await self._slots.acquire(PRIORITIES[tier], LLM_BACKLOG[tier], deadline)
+        try:
+            if deadline is None:
+                await self._bucket.acquire()
+            else:
+                try:
+                    await asyncio.wait_for(self._bucket.acquire(), max(deadline - time.monotonic(), 0))
+                except asyncio.TimeoutError:
+                    raise Overloaded('deadline passed waiting for the rate limit') from None
+            metrics.LLM_IN_FLIGHT.inc()
+            try:
+                yield
+            finally:
+                metrics.LLM_IN_FLIGHT.dec()
+        finally:
+            self._slots.release()
+
+chat_scheduler = ChatScheduler()
+
+_handed_off = contextvars.ContextVar('handed_off', default=None)
+
+def hand_off():
+    """Let the user's next update start while this handler keeps running.
+
+    For handlers that have queued their work somewhere that keeps order by
+    itself (ChatScheduler.submit) - call it right before that call, with no
+    await in between. A no-op outside UserUpdateProcessor.
+    """
+    event = _handed_off.get()
+    if event is not None:
+        event.set()
+
+class UserUpdateProcessor(BaseUpdateProcessor):
+    """Processes one update at a time per user, different users concurrently.
+
+    ConversationHandler needs a user's updates handled one by one: an answer
+    that arrives while the previous step is still writing its state would
+    see the old state. Handlers can release the user early with hand_off().
+    """
+
+    def __init__(self, max_concurrent_updates=UPDATE_CONCURRENCY):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}  # user_id -> [lock, updates holding or waiting for it]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_process_update(self, update, coroutine):
+        user = getattr(update, 'effective_user', None)
+        if user is None:
+            await coroutine
+            return
+
+        entry = self._locks.setdefault(user.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                released = asyncio.Event()
+                token = _handed_off.set(released)
+                try:
+                    task = asyncio.create_task(coroutine)
+                finally:
+                    _handed_off.reset(token)
+                waiter = asyncio.create_task(released.wait())
+                try:
+                    await asyncio.wait((task, waiter), return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    waiter.cancel()
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[user.id]
+        await task
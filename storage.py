@@ -0,0 +1,736 @@
+import logging
+import sqlite3
+import json
+import os
+import re
+import time
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Optional
+import metrics
+
+# Storage config
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sqlite')  # 'sqlite' or 'postgres'
+DB_PATH = os.getenv('DB_PATH', 'users.db')
+DATABASE_URL = os.getenv('DATABASE_URL')  # Postgres DSN when STORAGE_BACKEND=postgres
+DB_READERS = int(os.getenv('DB_READERS', '4'))
+SESSION_MESSAGE_LIMIT = 10
+HISTORY_RETENTION = int(os.getenv('HISTORY_RETENTION', '200'))  # Kept per user for summaries
+PAYMENT_SLACK = 600  # Seconds a transfer may predate its /start_session
+# Bump whenever create_schema changes - boots with a current database skip the DDL entirely
+SCHEMA_VERSION = 3
+
+logger = logging.getLogger(__name__)
+
+# All writes go through a single thread (SQLite only has one writer anyway),
+# reads fan out over a small pool. WAL lets readers run alongside the writer.
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+_readers = ThreadPoolExecutor(max_workers=DB_READERS, thread_name_prefix='db-reader')
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+
+class User(NamedTuple):
+    user_id: int
+    used_free_preview: int
+    system_prompt: Optional[str]
+    chat_history: str
+    current_session: str
+    message_count: int
+    girlfriend_name: str
+    user_name: Optional[str]
+    user_preferences: str
+
+USER_COLUMNS = ', '.join(User._fields)
+
+TABLES = ('users', 'pending_payments', 'messages', 'jetton_transfers', 'summaries', 'sync_state', 'bot_state', 'update_inbox',
+          'media_files', 'events')
+
+# Repository SQL below sticks to what SQLite and Postgres both accept
+# (ON CONFLICT upserts, RETURNING, row values) with sqlite-style ? / :name
+# placeholders; each backend only owns connections and schema.
+class SQLiteBackend:
+    name = 'sqlite'
+
+    def __init__(self, path):
+        self.path = path
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        # Only takes effect on a brand-new file, and must come before WAL is switched on
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')  # Safe with WAL, one fsync per checkpoint
+        conn.execute('PRAGMA busy_timeout = 5000')
+        conn.execute('PRAGMA cache_size = -16000')   # 16 MB page cache
+        conn.execute('PRAGMA temp_store = MEMORY')
+        conn.execute('PRAGMA mmap_size = 134217728')
+        return conn
+
+    def transaction(self, conn):
+        return conn
+
+    def create_schema(self, conn):
+        conn.execute('''CREATE TABLE IF NOT EXISTS users (
+                        user_id INTEGER PRIMARY KEY,
+                        used_free_preview INTEGER DEFAULT 0,
+                        system_prompt TEXT,
+                        chat_history TEXT DEFAULT '[]',
+                        current_session TEXT DEFAULT 'none',
+                        message_count INTEGER DEFAULT 0,
+                        girlfriend_name TEXT DEFAULT 'Your Girl',
+                        user_name TEXT,
+                        user_preferences TEXT DEFAULT '{}')''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS pending_payments (
+                        user_id INTEGER PRIMARY KEY,
+                        level TEXT,
+                        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS messages (
+                        user_id INTEGER NOT NULL,
+                        seq INTEGER NOT NULL,
+                        role TEXT NOT NULL,
+                        content TEXT NOT NULL,
+                        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                        PRIMARY KEY (user_id, seq)) WITHOUT ROWID''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_created_at ON messages (created_at)')
+        conn.execute('''CREATE TABLE IF NOT EXISTS jetton_transfers (
+                        tx_hash TEXT PRIMARY KEY,
+                        lt INTEGER NOT NULL,
+                        source TEXT NOT NULL,
+                        amount TEXT NOT NULL,
+                        utime INTEGER NOT NULL,
+                        matched_user INTEGER)''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_transfers_source_amount ON jetton_transfers (source, amount)')
+        conn.execute('''CREATE TABLE IF NOT EXISTS summaries (
+                        user_id INTEGER PRIMARY KEY,
+                        summary TEXT NOT NULL,
+                        through_seq INTEGER NOT NULL)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS sync_state (
+                        key TEXT PRIMARY KEY,
+                        value TEXT)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS bot_state (
+                        kind TEXT NOT NULL,
+                        key TEXT NOT NULL,
+                        value TEXT NOT NULL,
+                        PRIMARY KEY (kind, key)) WITHOUT ROWID''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS update_inbox (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        shard INTEGER NOT NULL,
+                        payload TEXT NOT NULL)''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_update_inbox_shard ON update_inbox (shard, id)')
+        conn.execute('''CREATE TABLE IF NOT EXISTS media_files (
+                        media_hash TEXT PRIMARY KEY,
+                        file_id TEXT NOT NULL,
+                        created_utime INTEGER NOT NULL) WITHOUT ROWID''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS events (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        kind TEXT NOT NULL,
+                        user_id INTEGER NOT NULL,
+                        level TEXT,
+                        amount INTEGER,
+                        created_utime INTEGER NOT NULL)''')
+        self._add_column(conn, 'pending_payments', 'ton_address', 'TEXT')
+        self._add_column(conn, 'pending_payments', 'created_utime', 'INTEGER')
+        self._add_column(conn, 'users', 'last_active', 'INTEGER')
+        conn.execute("UPDATE pending_payments SET created_utime = CAST(strftime('%s', timestamp) AS INTEGER) WHERE created_utime IS NULL")
+        _create_housekeeping_indexes(conn)
+        _migrate_chat_history(conn)
+
+    def schema_version(self, conn):
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+
+    def set_schema_version(self, conn, version):
+        conn.execute(f'PRAGMA user_version = {int(version)}')
+
+    def maintain(self, conn, vacuum_pages):
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            # File predates incremental vacuum - switching needs one full rebuild
+            logger.info("Converting database to incremental auto-vacuum (one-off VACUUM)")
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+        else:
+            conn.execute(f'PRAGMA incremental_vacuum({int(vacuum_pages)})')
+        conn.execute('PRAGMA analysis_limit = 1000')
+        conn.execute('PRAGMA optimize')  # ANALYZEs whatever has drifted
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def table_bytes(self, conn):
+        try:
+            return dict(conn.execute('SELECT name, sum(pgsize) FROM dbstat GROUP BY name').fetchall())
+        except sqlite3.OperationalError:
+            return {}  # SQLite built without dbstat
+
+    def _add_column(self, conn, table, column, decl):
+        columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+        if column not in columns:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
+
+class _PgConnection:
+    """Wraps a psycopg connection to accept the sqlite-style SQL used in this module"""
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    def execute(self, sql, params=()):
+        return self.raw.execute(_pg_sql(sql), params)
+
+    def executemany(self, sql, params_seq):
+        cursor = self.raw.cursor()
+        cursor.executemany(_pg_sql(sql), params_seq)
+        return cursor
+
+    def close(self):
+        self.raw.close()
+
+@functools.lru_cache(maxsize=256)
+def _pg_sql(sql):
+    # :name -> %(name)s and ? -> %s
+    sql = re.sub(r'(?<![:\w]):([A-Za-z_]\w*)', r'%(\1)s', sql)
+    return sql.replace('?', '%s')
+
+class PostgresBackend:
+    """Networked backend so several bot processes/hosts can share state.
+
+    Needs psycopg (the optional entry in requirements.txt), imported only when
+    selected. bench/run.py runs against it with STORAGE_BACKEND=postgres.
+    """
+    name = 'postgres'
+
+    def __init__(self, dsn):
+        if not dsn:
+            raise RuntimeError("Set DATABASE_URL to use STORAGE_BACKEND=postgres")
+        import psycopg
+        self._psycopg = psycopg
+        self.dsn = dsn
+
+    def connect(self):
+        # Autocommit for single reads; writes get explicit transaction() blocks
+        return _PgConnection(self._psycopg.connect(self.dsn, autocommit=True))
+
+    def transaction(self, conn):
+        return conn.raw.transaction()
+
+    def create_schema(self, conn):
+        conn.execute('''CREATE TABLE IF NOT EXISTS users (
+                        user_id BIGINT PRIMARY KEY,
+                        used_free_preview INTEGER DEFAULT 0,
+                        system_prompt TEXT,
+                        chat_history TEXT DEFAULT '[]',
+                        current_session TEXT DEFAULT 'none',
+                        message_count INTEGER DEFAULT 0,
+                        girlfriend_name TEXT DEFAULT 'Your Girl',
+                        user_name TEXT,
+                        user_preferences TEXT DEFAULT '{}')''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS pending_payments (
+                        user_id BIGINT PRIMARY KEY,
+                        level TEXT,
+                        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        ton_address TEXT,
+                        created_utime BIGINT)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS messages (
+                        user_id BIGINT NOT NULL,
+                        seq INTEGER NOT NULL,
+                        role TEXT NOT NULL,
+                        content TEXT NOT NULL,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        PRIMARY KEY (user_id, seq))''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_created_at ON messages (created_at)')
+        conn.execute('''CREATE TABLE IF NOT EXISTS jetton_transfers (
+                        tx_hash TEXT PRIMARY KEY,
+                        lt BIGINT NOT NULL,
+                        source TEXT NOT NULL,
+                        amount TEXT NOT NULL,
+                        utime BIGINT NOT NULL,
+                        matched_user BIGINT)''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_transfers_source_amount ON jetton_transfers (source, amount)')
+        conn.execute('''CREATE TABLE IF NOT EXISTS summaries (
+                        user_id BIGINT PRIMARY KEY,
+                        summary TEXT NOT NULL,
+                        through_seq INTEGER NOT NULL)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS sync_state (
+                        key TEXT PRIMARY KEY,
+                        value TEXT)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS bot_state (
+                        kind TEXT NOT NULL,
+                        key TEXT NOT NULL,
+                        value TEXT NOT NULL,
+                        PRIMARY KEY (kind, key))''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS update_inbox (
+                        id BIGSERIAL PRIMARY KEY,
+                        shard INTEGER NOT NULL,
+                        payload TEXT NOT NULL)''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_update_inbox_shard ON update_inbox (shard, id)')
+        conn.execute('''CREATE TABLE IF NOT EXISTS media_files (
+                        media_hash TEXT PRIMARY KEY,
+                        file_id TEXT NOT NULL,
+                        created_utime BIGINT NOT NULL)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS events (
+                        id BIGSERIAL PRIMARY KEY,
+                        kind TEXT NOT NULL,
+                        user_id BIGINT NOT NULL,
+                        level TEXT,
+                        amount BIGINT,
+                        created_utime BIGINT NOT NULL)''')
+        conn.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS last_active BIGINT')
+        _create_housekeeping_indexes(conn)
+
+    def schema_version(self, conn):
+        if conn.execute("SELECT to_regclass('sync_state')").fetchone()[0] is None:
+            return 0
+        row = conn.execute("SELECT value FROM sync_state WHERE key = 'schema_version'").fetchone()
+        return int(row[0]) if row else 0
+
+    def set_schema_version(self, conn, version):
+        conn.execute('''INSERT INTO sync_state (key, value) VALUES ('schema_version', ?)
+                        ON CONFLICT (key) DO UPDATE SET value = excluded.value''', (str(version),))
+
+    def maintain(self, conn, vacuum_pages):
+        # Plain VACUUM only marks space reusable - the Postgres analogue of incremental_vacuum
+        for table in TABLES:
+            conn.execute(f'VACUUM (ANALYZE) {table}')
+
+    def table_bytes(self, conn):
+        return {table: conn.execute('SELECT pg_total_relation_size(?::regclass)', (table,)).fetchone()[0] for table in TABLES}
+
+def _create_housekeeping_indexes(conn):
+    # Time-based scans for the housekeeping jobs; existing users get a fresh activity stamp
+    conn.execute('UPDATE users SET last_active = ? WHERE last_active IS NULL', (int(time.time()),))
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_last_active ON users (last_active)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_pending_payments_created ON pending_payments (created_utime)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_media_files_created ON media_files (created_utime)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_events_user ON events (user_id, kind)')
+
+def _create_backend():
+    if STORAGE_BACKEND == 'postgres':
+        return PostgresBackend(DATABASE_URL)
+    return SQLiteBackend(DB_PATH)
+
+backend = _create_backend()
+
+def get_connection():
+    """Return this thread's long-lived connection, opening it on first use"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = backend.connect()
+        _local.conn = conn
+        with _connections_lock:
+            _connections.append(conn)
+    return conn
+
+def init_db():
+    """Create or migrate the schema, unless the database is already at SCHEMA_VERSION"""
+    conn = get_connection()
+    version = backend.schema_version(conn)
+    if version == SCHEMA_VERSION:
+        return
+    if version > SCHEMA_VERSION:
+        logger.warning(f"Database schema v{version} is newer than this code (v{SCHEMA_VERSION})")
+        return
+    started = time.monotonic()
+    with backend.transaction(conn):
+        backend.create_schema(conn)
+        backend.set_schema_version(conn, SCHEMA_VERSION)
+    logger.info(f"Migrated database schema v{version} -> v{SCHEMA_VERSION} in {time.monotonic() - started:.2f}s")
+
+def _migrate_chat_history(conn):
+    # Move legacy users.chat_history JSON blobs into the messages table. The
+    # blob is cleared afterwards so this is a no-op once everyone is migrated.
+    moved = conn.execute('''INSERT OR IGNORE INTO messages (user_id, seq, role, content)
+                            SELECT u.user_id, j.key + 1, json_extract(j.value, '$.role'), json_extract(j.value, '$.content')
+                            FROM users u, json_each(u.chat_history) j
+                            WHERE u.chat_history IS NOT NULL AND u.chat_history NOT IN ('', '[]')''').rowcount
+    if moved > 0:
+        conn.execute("UPDATE users SET chat_history = '[]' WHERE chat_history NOT IN ('', '[]')")
+        logger.info(f"Migrated {moved} chat history entries to messages table")
+
+def close():
+    """Shut down the executors and close every pooled connection"""
+    _writer.shutdown(wait=True)
+    _readers.shutdown(wait=True)
+    with _connections_lock:
+        for conn in _connections:
+            conn.close()
+        _connections.clear()
+
+async def _run(executor, kind, op, fn):
+    """Run fn on the executor, timing the queue wait (our lock wait) and the whole call"""
+    submitted = time.monotonic()
+
+    def _timed():
+        metrics.DB_WAIT.labels(kind).observe(time.monotonic() - submitted)
+        return fn()
+
+    loop = asyncio.get_running_loop()
+    try:
+        with metrics.span(f'db.{op}'):
+            return await loop.run_in_executor(executor, _timed)
+    finally:
+        metrics.DB_CALL.labels(kind, op).observe(time.monotonic() - submitted)
+
+async def run_read(op, fn, *args):
+    """Run fn(conn, *args) on a reader thread; op names the call in metrics, e.g. 'get_context'"""
+    return await _run(_readers, 'read', op, lambda: fn(get_connection(), *args))
+
+async def run_write(op, fn, *args):
+    """Run fn(conn, *args) inside a transaction on the writer thread"""
+    def _tx():
+        conn = get_connection()
+        with backend.transaction(conn):
+            return fn(conn, *args)
+    return await _run(_writer, 'write', op, _tx)
+
+# Analytics events - append-only, written in the same transaction as the change they record
+def _record_event(conn, kind, user_id, level=None, amount=None):
+    conn.execute('INSERT INTO events (kind, user_id, level, amount, created_utime) VALUES (?, ?, ?, ?, ?)',
+                 (kind, user_id, level, amount, int(time.time())))
+
+# Users
+def _get_user(conn, user_id):
+    row = conn.execute(f'SELECT {USER_COLUMNS} FROM users WHERE user_id = ?', (user_id,)).fetchone()
+    return User(*row) if row else None
+
+async def get_user(user_id: int) -> Optional[User]:
+    return await run_read('get_user', _get_user, user_id)
+
+async def ensure_user(user_id: int) -> None:
+    await run_write('ensure_user', lambda conn: conn.execute(
+        'INSERT INTO users (user_id, last_active) VALUES (?, ?) ON CONFLICT DO NOTHING', (user_id, int(time.time()))))
+
+async def start_free_preview(user_id: int) -> None:
+    def _start(conn):
+        conn.execute('UPDATE users SET current_session = ?, message_count = 0, used_free_preview = 1 WHERE user_id = ?',
+                     ('mild', user_id))
+        _record_event(conn, 'session_start', user_id, 'preview')
+    await run_write('start_free_preview', _start)
+
+async def save_girlfriend(user_id: int, system_prompt: str, gf_name: str) -> None:
+    def _save(conn):
+        conn.execute('UPDATE users SET system_prompt = ?, girlfriend_name = ? WHERE user_id = ?',
+                     (system_prompt, gf_name, user_id))
+        conn.execute('DELETE FROM messages WHERE user_id = ?', (user_id,))
+        conn.execute('DELETE FROM summaries WHERE user_id = ?', (user_id,))
+    await run_write('save_girlfriend', _save)
+
+async def reset_girlfriend(user_id: int) -> None:
+    def _reset(conn):
+        conn.execute("UPDATE users SET system_prompt = NULL, girlfriend_name = 'Your Girl', user_name = NULL WHERE user_id = ?",
+                     (user_id,))
+        conn.execute('DELETE FROM messages WHERE user_id = ?', (user_id,))
+        conn.execute('DELETE FROM summaries WHERE user_id = ?', (user_id,))
+    await run_write('reset_girlfriend', _reset)
+
+# Chat history
+class Turn(NamedTuple):
+    message_count: int
+    session_ended: bool
+
+# Bumps the counter and closes the session at the limit in one statement.
+# Only matches an active session, so concurrent turns can't overrun the limit.
+COUNT_TURN_SQL = '''
+UPDATE users SET
+    message_count = CASE WHEN message_count + 1 >= :session_limit THEN 0 ELSE message_count + 1 END,
+    current_session = CASE WHEN message_count + 1 >= :session_limit THEN 'none' ELSE current_session END,
+    last_active = :now
+WHERE user_id = :user_id AND current_session != 'none'
+RETURNING message_count, current_session
+'''
+
+# Facts picked up from the message; a name is only ever set once
+SAVE_FACTS_SQL = '''
+UPDATE users SET
+    user_name = coalesce(user_name, :user_name),
+    user_preferences = coalesce(:user_preferences, user_preferences)
+WHERE user_id = :user_id
+'''
+
+# The ended session's level comes from its start event ('preview' rather than
+# 'mild'); sessions from before events were recorded fall back to the row's level
+LAST_SESSION_START_SQL = '''
+SELECT level FROM events WHERE user_id = ? AND kind = 'session_start' ORDER BY id DESC LIMIT 1
+'''
+
+def _record_turn(conn, user_id, user_message, reply, facts):
+    # Read before COUNT_TURN_SQL resets it on the session's last message
+    level = conn.execute('SELECT current_session FROM users WHERE user_id = ?', (user_id,)).fetchone()
+    rows = conn.execute(COUNT_TURN_SQL, {
+        'user_id': user_id,
+        'session_limit': SESSION_MESSAGE_LIMIT,
+        'now': int(time.time())
+    }).fetchall()
+    if not rows:
+        return None
+
+    if facts:
+        conn.execute(SAVE_FACTS_SQL, {
+            'user_id': user_id,
+            'user_name': facts.get('user_name'),
+            'user_preferences': facts.get('user_preferences')
+        })
+
+    # Append-only: two inserts at the end of the user's (user_id, seq) range
+    last_seq = conn.execute('SELECT coalesce(max(seq), 0) FROM messages WHERE user_id = ?', (user_id,)).fetchone()[0]
+    conn.executemany('INSERT INTO messages (user_id, seq, role, content) VALUES (?, ?, ?, ?)', [
+        (user_id, last_seq + 1, 'user', user_message),
+        (user_id, last_seq + 2, 'assistant', reply)
+    ])
+
+    # Messages are compacted and archived away, so reporting counts these instead
+    _record_event(conn, 'message', user_id, level[0])
+
+    count, session = rows[0]
+    if session == 'none':
+        started = conn.execute(LAST_SESSION_START_SQL, (user_id,)).fetchone()
+        _record_event(conn, 'session_end', user_id, started[0] if started else level[0])
+    return Turn(count, session == 'none')
+
+async def record_turn(user_id: int, user_message: str, reply: str, facts: Optional[dict] = None) -> Optional[Turn]:
+    """Persist one exchange and count it against the session in a single round trip.
+
+    facts (from extraction.extract_facts) are saved in the same transaction.
+    Returns None if the user has no active session (e.g. a concurrent turn
+    just used up the last message), in which case nothing is written.
+    """
+    return await run_write('record_turn', _record_turn, user_id, user_message, reply, facts)
+
+class Context(NamedTuple):
+    messages: list  # (seq, role, content), oldest first
+    summary: Optional[str]
+    summary_through_seq: int
+
+def _get_context(conn, user_id, limit):
+    rows = conn.execute('SELECT seq, role, content FROM messages WHERE user_id = ? ORDER BY seq DESC LIMIT ?',
+                        (user_id, limit)).fetchall()
+    summary = conn.execute('SELECT summary, through_seq FROM summaries WHERE user_id = ?', (user_id,)).fetchone()
+    return Context(rows[::-1], summary[0] if summary else None, summary[1] if summary else 0)
+
+async def get_context(user_id: int, limit: int) -> Context:
+    """Newest `limit` messages plus the rolling summary of older ones, in one read"""
+    return await run_read('get_context', _get_context, user_id, limit)
+
+async def get_messages_between(user_id: int, after_seq: int, through_seq: int) -> list:
+    """(seq, role, content) rows with after_seq < seq <= through_seq, oldest first"""
+    return await run_read('get_messages_between', lambda conn: conn.execute(
+        'SELECT seq, role, content FROM messages WHERE user_id = ? AND seq > ? AND seq <= ? ORDER BY seq',
+        (user_id, after_seq, through_seq)).fetchall())
+
+async def save_summary(user_id: int, summary: str, through_seq: int) -> None:
+    # Never move the summary backwards if an older job finishes late
+    await run_write('save_summary', lambda conn: conn.execute(
+        '''INSERT INTO summaries (user_id, summary, through_seq) VALUES (?, ?, ?)
+           ON CONFLICT (user_id) DO UPDATE SET summary = excluded.summary, through_seq = excluded.through_seq
+           WHERE excluded.through_seq > summaries.through_seq''',
+        (user_id, summary, through_seq)))
+
+def _compact_history(conn, retention):
+    # Drop everything older than the newest `retention` messages per user
+    return conn.execute('''DELETE FROM messages WHERE (user_id, seq) IN (
+                              SELECT m.user_id, m.seq FROM messages m
+                              JOIN (SELECT user_id, max(seq) AS last_seq FROM messages GROUP BY user_id) t
+                                ON t.user_id = m.user_id
+                              WHERE m.seq <= t.last_seq - ?)''', (retention,)).rowcount
+
+async def compact_history(retention: int = HISTORY_RETENTION) -> int:
+    """Apply the per-user retention window, returning the number of rows removed"""
+    return await run_write('compact_history', _compact_history, retention)
+
+# Payments
+async def create_pending_payment(user_id: int, level: str) -> None:
+    await run_write('create_pending_payment', lambda conn: conn.execute(
+        '''INSERT INTO pending_payments (user_id, level, created_utime) VALUES (?, ?, ?)
+           ON CONFLICT (user_id) DO UPDATE SET level = excluded.level, timestamp = CURRENT_TIMESTAMP,
+                                               created_utime = excluded.created_utime, ton_address = NULL''',
+        (user_id, level, int(time.time()))))
+
+async def get_pending_level(user_id: int) -> Optional[str]:
+    row = await run_read('get_pending_level', lambda conn: conn.execute(
+        'SELECT level FROM pending_payments WHERE user_id = ?', (user_id,)).fetchone())
+    return row[0] if row else None
+
+def _activate_session(conn, user_id, level):
+    conn.execute('DELETE FROM pending_payments WHERE user_id = ?', (user_id,))
+    conn.execute('UPDATE users SET current_session = ?, message_count = 0, last_active = ? WHERE user_id = ?',
+                 (level, int(time.time()), user_id))
+    row = conn.execute('SELECT girlfriend_name FROM users WHERE user_id = ?', (user_id,)).fetchone()
+    return row[0] if row else 'Your Girl'
+
+# Only transfers made after the payment was requested (minus some clock slack) count
+CLAIM_TRANSFER_SQL = '''
+UPDATE jetton_transfers SET matched_user = :user_id
+WHERE tx_hash = (
+    SELECT t.tx_hash FROM jetton_transfers t, pending_payments p
+    WHERE p.user_id = :user_id AND t.source = p.ton_address AND t.amount = :amount
+      AND t.matched_user IS NULL
+      AND t.utime >= coalesce(p.created_utime, 0) - :slack
+    ORDER BY t.utime LIMIT 1)
+RETURNING tx_hash
+'''
+
+def _claim_transfer(conn, user_id, level, amount):
+    claimed = conn.execute(CLAIM_TRANSFER_SQL, {'user_id': user_id, 'amount': amount, 'slack': PAYMENT_SLACK}).fetchall()
+    if not claimed:
+        return None
+    _record_event(conn, 'payment', user_id, level, int(amount))
+    _record_event(conn, 'session_start', user_id, level)
+    return _activate_session(conn, user_id, level)
+
+async def confirm_pending_payment(user_id: int, ton_address: str, amounts: dict) -> Optional[str]:
+    """Record the payer's address and try to match an indexed transfer.
+
+    amounts maps level -> expected jetton amount (as the API string). On a
+    match the transfer is claimed and the session activated in the same
+    transaction, and the girlfriend's name is returned; otherwise None.
+    """
+    def _confirm(conn):
+        row = conn.execute('UPDATE pending_payments SET ton_address = ? WHERE user_id = ? RETURNING level',
+                           (ton_address, user_id)).fetchall()
+        if not row:
+            return None
+        level = row[0][0]
+        return _claim_transfer(conn, user_id, level, amounts[level])
+    return await run_write('confirm_pending_payment', _confirm)
+
+async def match_pending_payments(amounts: dict) -> list:
+    """Claim transfers for every pending payment that has an address.
+
+    Returns (user_id, level, girlfriend_name) for each activated session.
+    """
+    def _match(conn):
+        pending = conn.execute('SELECT user_id, level FROM pending_payments WHERE ton_address IS NOT NULL').fetchall()
+        activated = []
+        for user_id, level in pending:
+            gf_name = _claim_transfer(conn, user_id, level, amounts[level])
+            if gf_name is not None:
+                activated.append((user_id, level, gf_name))
+        return activated
+    return await run_write('match_pending_payments', _match)
+
+# Jetton transfer index
+async def get_sync_value(key: str) -> Optional[str]:
+    row = await run_read('get_sync_value', lambda conn: conn.execute(
+        'SELECT value FROM sync_state WHERE key = ?', (key,)).fetchone())
+    return row[0] if row else None
+
+async def save_transfers(transfers: list, cursor_key: str, cursor_value: str) -> None:
+    """Index (tx_hash, lt, source, amount, utime) rows and advance the poll cursor together"""
+    def _save(conn):
+        conn.executemany('''INSERT INTO jetton_transfers (tx_hash, lt, source, amount, utime) VALUES (?, ?, ?, ?, ?)
+                            ON CONFLICT DO NOTHING''',
+                         transfers)
+        conn.execute('INSERT INTO sync_state (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value',
+                     (cursor_key, cursor_value))
+    await run_write('save_transfers', _save)
+
+# Bot persistence - python-telegram-bot conversation states and user_data
+async def load_bot_state(kind: str) -> dict:
+    rows = await run_read('load_bot_state', lambda conn: conn.execute(
+        'SELECT key, value FROM bot_state WHERE kind = ?', (kind,)).fetchall())
+    return {key: json.loads(value) for key, value in rows}
+
+async def save_bot_state(kind: str, key: str, value) -> None:
+    """Upsert one entry; value None deletes it"""
+    def _save(conn):
+        if value is None:
+            conn.execute('DELETE FROM bot_state WHERE kind = ? AND key = ?', (kind, key))
+        else:
+            conn.execute('''INSERT INTO bot_state (kind, key, value) VALUES (?, ?, ?)
+                            ON CONFLICT (kind, key) DO UPDATE SET value = excluded.value''',
+                         (kind, key, json.dumps(value)))
+    await run_write('save_bot_state', _save)
+
+# Update inbox - front-ends enqueue, one worker per shard consumes in order
+async def enqueue_update(shard: int, payload: str) -> None:
+    await run_write('enqueue_update', lambda conn: conn.execute(
+        'INSERT INTO update_inbox (shard, payload) VALUES (?, ?)', (shard, payload)))
+
+async def take_updates(shard: int, limit: int = 100) -> list:
+    """Remove and return up to `limit` queued update payloads for a shard, oldest first"""
+    def _take(conn):
+        rows = conn.execute('''DELETE FROM update_inbox WHERE id IN (
+                                   SELECT id FROM update_inbox WHERE shard = ? ORDER BY id LIMIT ?)
+                               RETURNING id, payload''', (shard, limit)).fetchall()
+        return [payload for _, payload in sorted(rows)]
+    return await run_write('take_updates', _take)
+
+async def get_media_file_id(media_hash: str) -> Optional[str]:
+    row = await run_read('get_media_file_id', lambda conn: conn.execute(
+        'SELECT file_id FROM media_files WHERE media_hash = ?', (media_hash,)).fetchone())
+    return row[0] if row else None
+
+async def save_media_file_id(media_hash: str, file_id: str) -> None:
+    await run_write('save_media_file_id', lambda conn: conn.execute(
+        '''INSERT INTO media_files (media_hash, file_id, created_utime) VALUES (?, ?, ?)
+           ON CONFLICT (media_hash) DO UPDATE SET file_id = excluded.file_id''',
+        (media_hash, file_id, int(time.time()))))
+
+# Housekeeping
+async def expire_pending_payments(max_age: int) -> int:
+    """Drop /start_session requests older than max_age seconds, returning how many"""
+    return await run_write('expire_pending_payments', lambda conn: conn.execute(
+        'DELETE FROM pending_payments WHERE created_utime < ?', (int(time.time()) - max_age,)).rowcount)
+
+async def expire_media_files(max_age: int) -> int:
+    """Forget file_ids stored more than max_age seconds ago, returning how many"""
+    return await run_write('expire_media_files', lambda conn: conn.execute(
+        'DELETE FROM media_files WHERE created_utime < ?', (int(time.time()) - max_age,)).rowcount)
+
+# Inactive users without a running session, and how far their history can be archived
+ARCHIVABLE_SQL = '''
+SELECT m.user_id, m.seq, m.role, m.content, m.created_at FROM messages m
+JOIN (SELECT u.user_id, max(h.seq) - :keep AS through_seq
+      FROM users u JOIN messages h ON h.user_id = u.user_id
+      WHERE u.last_active < :inactive_since AND u.current_session = 'none'
+      GROUP BY u.user_id HAVING count(*) > :keep
+      LIMIT :max_users) t ON t.user_id = m.user_id
+WHERE m.seq <= t.through_seq
+ORDER BY m.user_id, m.seq
+'''
+
+async def get_archivable_messages(inactive_since: int, keep: int, max_users: int) -> list:
+    """(user_id, seq, role, content, created_at) rows of inactive users, all but their newest `keep`"""
+    return await run_read('get_archivable_messages', lambda conn: conn.execute(ARCHIVABLE_SQL, {
+        'inactive_since': inactive_since,
+        'keep': keep,
+        'max_users': max_users
+    }).fetchall())
+
+async def delete_messages_through(through: dict) -> int:
+    """Delete each user's messages up to and including through[user_id]"""
+    return await run_write('delete_messages_through', lambda conn: conn.executemany(
+        'DELETE FROM messages WHERE user_id = ? AND seq <= ?', list(through.items())).rowcount)
+
+# system_prompt is also NULL after /reset_gf - only users who never used the
+# preview or paid are purged, or they'd get a second preview / lose a session
+PURGE_USERS_SQL = '''
+    DELETE FROM users WHERE system_prompt IS NULL AND used_free_preview = 0 AND current_session = 'none'
+      AND last_active < ? AND user_id NOT IN (SELECT user_id FROM pending_payments)
+    RETURNING user_id'''
+
+async def purge_abandoned_users(inactive_since: int) -> int:
+    """Remove users who never finished /find_gf and haven't been seen since inactive_since, with their rows"""
+    def _purge(conn):
+        purged = [(user_id,) for user_id, in conn.execute(PURGE_USERS_SQL, (inactive_since,)).fetchall()]
+        for table in ('messages', 'summaries', 'events'):
+            conn.executemany(f'DELETE FROM {table} WHERE user_id = ?', purged)
+        return len(purged)
+    return await run_write('purge_abandoned_users', _purge)
+
+async def optimize(vacuum_pages: int) -> None:
+    """Reclaim free pages and refresh planner statistics (runs outside any transaction)"""
+    await _run(_writer, 'write', 'optimize', lambda: backend.maintain(get_connection(), vacuum_pages))
+
+async def table_stats() -> dict:
+    """table -> (rows, bytes or None); bytes include the table's indexes where the backend can tell"""
+    def _stats(conn):
+        sizes = backend.table_bytes(conn)
+        index_bytes = {}
+        if backend.name == 'sqlite':
+            for name, table in conn.execute("SELECT name, tbl_name FROM sqlite_master WHERE type = 'index'"):
+                index_bytes[table] = index_bytes.get(table, 0) + sizes.get(name, 0)
+        return {
+            table: (conn.execute(f'SELECT count(*) FROM {table}').fetchone()[0],
+                    sizes[table] + index_bytes.get(table, 0) if table in sizes else None)
+            for table in TABLES
+        }
+    return await run_read('table_stats', _stats)
@@ -0,0 +1,85 @@
+import logging
+import os
+import time
+import asyncio
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from pacing import pace
+from outbound import best_effort
+
+# Telegram tolerates roughly one edit per second per chat before flood control
+EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.0'))
+
+logger = logging.getLogger(__name__)
+
+class ProgressiveReply:
+    """Telegram message that grows as an LLM reply streams in.
+
+    The first chunk is sent as a new reply straight away. Later chunks are
+    merged and applied with at most one edit_message_text per EDIT_INTERVAL,
+    and finish() writes the final text. If `started` (time.monotonic()) is
+    given, the first send is held back to the humanized pacing floor.
+    """
+
+    def __init__(self, message, interval=EDIT_INTERVAL, started=None):
+        self.message = message
+        self.interval = interval
+        self.started = started
+        self.sent = None
+        self._latest = ''
+        self._shown = ''
+        self._last_edit = 0.0
+        self._flush_task = None
+
+    async def update(self, text):
+        """Stream callback - record the newest text and schedule an edit"""
+        self._latest = text
+        if not text.strip():
+            return
+        if self.sent is None:
+            if self.started is not None:
+                await pace(self.started, len(text))
+            self.sent = await self.message.reply_text(self._latest)
+            self._shown = self._latest
+            self._last_edit = time.monotonic()
+            return
+        # Only one pending edit at a time; it picks up whatever is latest when it fires
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        delay = self._last_edit + self.interval - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self._edit(self._latest)
+
+    async def _edit(self, text, final=False):
+        if text == self._shown or not text.strip():
+            return
+        try:
+            if final:
+                await self.sent.edit_text(text)
+            else:
+                # Intermediate edits queue behind other replies and are skipped under flood control;
+                # the send limiter retries the final one
+                with best_effort():
+                    await self.sent.edit_text(text)
+            self._shown = text
+        except RetryAfter as e:
+            logger.warning(f"Edit throttled by Telegram, retry after {e.retry_after}s")
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                logger.error(f"Error editing streamed reply: {e}")
+        except TelegramError as e:
+            logger.error(f"Error editing streamed reply: {e}")
+        self._last_edit = time.monotonic()
+
+    async def finish(self, text):
+        """Deliver the final text, replacing any partial stream"""
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        if self.sent is None:
+            if self.started is not None:
+                await pace(self.started, len(text))
+            await self.message.reply_text(text)
+            return
+        await self._edit(text, final=True)
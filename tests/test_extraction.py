@@ -0,0 +1,45 @@
+import json
+import pytest
+from storage import User
+from extraction import extract_facts
+
+NEW_USER = User(1, 1, 'prompt', '[]', 'mild', 0, 'Your Girl', None, '{}')
+
+NAMES = [
+    ("my name is Jake", 'Jake'),
+    ("my name is jake lol", 'Jake'),
+    ("name's Chris btw", 'Chris'),
+    ("call me Mike", 'Mike'),
+    ("I'm Tom, nice to meet you", 'Tom'),
+    ("call me when you get home", None),
+    ("call me later babe", None),
+    ("Call me maybe", None),
+    ("Call me Maybe", None),
+    ("call me daddy", None),
+    ("I'm tired", None),
+    ("i'm so bored", None),
+    ("im here", None),
+]
+
+@pytest.mark.parametrize('message, expected', NAMES)
+def test_name(message, expected):
+    facts = extract_facts(NEW_USER, message) or {}
+    assert facts.get('user_name') == expected
+
+def test_known_name_is_kept():
+    user = NEW_USER._replace(user_name='Jake')
+    assert extract_facts(user, "call me Mike") is None
+
+PREFERENCES = [
+    ("i'm 25 years old", {'age': 25}),
+    ("I'm from New York", {'location': 'New York'}),
+    ("i really like hiking and cooking", {'likes': ['hiking']}),
+    ("i love it when you talk like that", None),
+    ("im 12", None),
+]
+
+@pytest.mark.parametrize('message, expected', PREFERENCES)
+def test_preferences(message, expected):
+    facts = extract_facts(NEW_USER, message) or {}
+    prefs = json.loads(facts['user_preferences']) if 'user_preferences' in facts else None
+    assert prefs == expected
@@ -0,0 +1,164 @@
+import logging
+import os
+import asyncio
+import fcntl
+import secrets
+import uvicorn
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, Response
+from telegram import Bot, Update
+import storage
+import worker
+import metrics
+import analytics
+
+# Webhook config
+TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')  # Same server the bot talks to, see bot.py
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Public base URL, e.g. https://bot.example.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEB_HOST = os.getenv('WEB_HOST', '0.0.0.0')
+WEB_PORT = int(os.getenv('WEB_PORT', '8000'))
+# Without UPDATE_SHARDS each worker runs its own Application, and Telegram spreads a
+# user's updates across them - so unsharded webhook mode is a single process
+WEB_WORKERS = int(os.getenv('WEB_WORKERS', '2' if worker.UPDATE_SHARDS > 0 else '1'))
+JOB_LOCK_PATH = os.getenv('JOB_LOCK_PATH', 'jobs.lock')
+
+logger = logging.getLogger(__name__)
+
+_job_lock = None
+
+def _acquire_job_lock():
+    """True for exactly one worker process - that one runs the background jobs"""
+    global _job_lock
+    handle = open(JOB_LOCK_PATH, 'w')
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        return False
+    _job_lock = handle  # Held until the process exits
+    return True
+
+def create_app():
+    """FastAPI app that feeds Telegram webhook updates into the bot's update queue.
+
+    With UPDATE_SHARDS set it is a stateless front-end instead: updates are
+    routed into the shared inbox by user and handled by `BOT_MODE=worker`
+    processes, so a user's updates always reach the same worker.
+    """
+    if worker.UPDATE_SHARDS > 0:
+        return _create_router_app()
+
+    # Only full workers load the handlers (and the LLM, image and payment clients behind them)
+    import bot
+    tg_app = bot.build_application(run_jobs=_acquire_job_lock())
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        # Same lifecycle run_polling() would give us, minus the polling
+        await tg_app.initialize()
+        await tg_app.post_init(tg_app)
+        await tg_app.start()
+        yield
+        # Graceful shutdown: stop taking updates, let in-flight handlers finish
+        await tg_app.stop()
+        await tg_app.shutdown()
+        await tg_app.post_shutdown(tg_app)
+
+    app = FastAPI(lifespan=lifespan, docs_url=None, redoc_url=None, openapi_url=None)
+    app.state.tg_app = tg_app
+
+    @app.post(WEBHOOK_PATH)
+    async def telegram_update(request: Request):
+        if not _authorized(request):
+            return Response(status_code=403)
+        update = Update.de_json(await request.json(), tg_app.bot)
+        await tg_app.update_queue.put(update)
+        return Response(status_code=200)
+
+    @app.get('/health')
+    async def health():
+        ok = tg_app.running
+        return Response(content='ok' if ok else 'starting', status_code=200 if ok else 503)
+
+    app.add_api_route('/metrics', metrics_endpoint, methods=['GET'])
+    if analytics.ADMIN_TOKEN:
+        app.add_api_route('/admin/stats', admin_stats, methods=['GET'])
+
+    return app
+
+def _create_router_app():
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        yield
+        storage.close()
+
+    app = FastAPI(lifespan=lifespan, docs_url=None, redoc_url=None, openapi_url=None)
+
+    @app.post(WEBHOOK_PATH)
+    async def telegram_update(request: Request):
+        if not _authorized(request):
+            return Response(status_code=403)
+        await worker.route_update(await request.json())
+        return Response(status_code=200)
+
+    @app.get('/health')
+    async def health():
+        return Response(content='ok')
+
+    app.add_api_route('/metrics', metrics_endpoint, methods=['GET'])
+    if analytics.ADMIN_TOKEN:
+        app.add_api_route('/admin/stats', admin_stats, methods=['GET'])
+
+    return app
+
+async def metrics_endpoint():
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
+async def admin_stats(request: Request, days: int = 7):
+    """Business aggregates from the analytics snapshot - never touches the live database"""
+    token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not secrets.compare_digest(token, analytics.ADMIN_TOKEN):
+        return Response(status_code=403)
+    return await asyncio.to_thread(analytics.report, days)
+
+def _authorized(request):
+    token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    return not WEBHOOK_SECRET or secrets.compare_digest(token, WEBHOOK_SECRET)
+
+async def register_webhook():
+    # Registered on the server that will deliver the updates - a self-hosted Bot API if configured
+    urls = {}
+    if TELEGRAM_API_URL:
+        urls = {'base_url': f'{TELEGRAM_API_URL.rstrip("/")}/bot', 'base_file_url': f'{TELEGRAM_API_URL.rstrip("/")}/file/bot'}
+    async with Bot(TELEGRAM_TOKEN, **urls) as tg_bot:
+        await tg_bot.set_webhook(
+            url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES
+        )
+
+def serve():
+    """Register the webhook once, then run the FastAPI app under uvicorn workers"""
+    if not WEBHOOK_URL:
+        logger.error("ERROR: Set WEBHOOK_URL environment variable for webhook mode!")
+        return
+    if WEB_WORKERS > 1 and worker.UPDATE_SHARDS <= 0:
+        logger.error("ERROR: WEB_WORKERS > 1 needs UPDATE_SHARDS - unsharded workers don't share conversation state")
+        return
+    if not WEBHOOK_SECRET:
+        logger.warning("WEBHOOK_SECRET is not set - anyone who finds the URL can post updates")
+
+    asyncio.run(register_webhook())
+    uvicorn.run(
+        'webhook:create_app',
+        factory=True,
+        host=WEB_HOST,
+        port=WEB_PORT,
+        workers=WEB_WORKERS,
+        timeout_graceful_shutdown=30,
+        log_level='warning'
+    )
@@ -0,0 +1,64 @@
+import logging
+import os
+import json
+import signal
+import asyncio
+from telegram import Update
+import storage
+import metrics
+
+# Sharding config - every process must agree on UPDATE_SHARDS
+UPDATE_SHARDS = int(os.getenv('UPDATE_SHARDS', '0'))  # 0 = no routing, webhook workers handle updates directly
+WORKER_SHARD = int(os.getenv('WORKER_SHARD', '0'))
+WORKER_POLL_INTERVAL = float(os.getenv('WORKER_POLL_INTERVAL', '0.05'))
+
+logger = logging.getLogger(__name__)
+
+def shard_for(data):
+    """Pick the shard for a raw update - all updates from one user land on the same worker"""
+    update = Update.de_json(data, None)
+    if update.effective_user:
+        key = update.effective_user.id
+    elif update.effective_chat:
+        key = update.effective_chat.id
+    else:
+        key = update.update_id
+    return key % UPDATE_SHARDS
+
+async def route_update(data):
+    await storage.enqueue_update(shard_for(data), json.dumps(data))
+
+async def run_worker():
+    import bot  # Not at module level - the webhook router imports this module for shard_for()
+    # Shard 0 also runs the background jobs so they happen exactly once
+    tg_app = bot.build_application(run_jobs=WORKER_SHARD == 0)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with tg_app:
+        await tg_app.post_init(tg_app)
+        await tg_app.start()
+        logger.info(f"Worker for shard {WORKER_SHARD}/{UPDATE_SHARDS} running")
+
+        while not stop.is_set():
+            payloads = await storage.take_updates(WORKER_SHARD)
+            for payload in payloads:
+                await tg_app.update_queue.put(Update.de_json(json.loads(payload), tg_app.bot))
+            if not payloads:
+                try:
+                    await asyncio.wait_for(stop.wait(), WORKER_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+
+        # Graceful shutdown: finish in-flight handlers, leave the rest queued for the next run
+        await tg_app.stop()
+    await tg_app.post_shutdown(tg_app)
+
+def serve():
+    if UPDATE_SHARDS <= 0 or not 0 <= WORKER_SHARD < UPDATE_SHARDS:
+        logger.error("ERROR: Worker mode needs UPDATE_SHARDS > 0 and 0 <= WORKER_SHARD < UPDATE_SHARDS!")
+        return
+    metrics.serve_standalone()
+    asyncio.run(run_worker())